@@ -10,11 +10,22 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
 import file_utils as fu
 import utils as u
+import intervals
+import binning
+import vcfrecord
+import bgzf
+import bloom
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+# Counts every annotator keeps of its annotation cache lookups
+CACHE_COUNTERS = ('cache_hits', 'cache_misses')
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -59,7 +70,7 @@ def binarySearchUniqueAndSorted(arg0, key):
     obj = 0;
 
     while (low <= high):
-        mid = (low + high) / 2
+        mid = (low + high) // 2
         obj = arg0[mid]
 
         if (obj < key):
@@ -107,1023 +118,1526 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+"""Base class for per-record annotators
+   Each annotation stage is a RecordAnnotator: it gets the VcfRecord of
+   one VCF record, adds its annotation and keeps the counts it reports in
+   the .count.log. The same annotators back the multi-pass functions below
+   and the fused single-pass mode in driver.py.
+   Given a ReferenceStore (see refstore.py) an annotator reads the local
+   store instead of sending queries through cursor. With bin_queries range
+   queries also select on the UCSC bin column (see binning.py).
+"""
+class RecordAnnotator(object):
+    # Attributes holding the counts written by writeLog
+    counters = ()
+    # Whether annotate writes the ID column, and the separator it rejoins
+    # the record with, if any; both are replayed from the annotation cache
+    cacheId = False
+    joinSep = None
+
+    def __init__(self, cursor, format='vcf', store=None, bin_queries=False):
+        self.cursor = cursor
+        self.inds = getFormatSpecificIndices(format=format)
+        self.store = store
+        self.bin_queries = bin_queries
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    """Condition on bin for a range query on table over [lo, hi], if bin
+       queries are on and the table has a bin column
+    """
+    def binClause(self, table, lo, hi, cursor=None):
+        if self.bin_queries and binning.hasBin(cursor or self.cursor, table):
+            return binning.binClause(lo, hi)
+        return ''
+
+    """Lines starting with '#' are passed through untouched
+    """
+    def isRecord(self, line):
+        return not line.startswith('#')
+
+    """Called with a window of lines before they are annotated one by one,
+       so annotators can resolve the whole window in bulk
+    """
+    def prefetch(self, lines, sep='\t'):
+        pass
+
+    """Keys of the records in lines that annotate would look up in the
+       database one query at a time; lookup runs the query of a key on
+       cursor. A Lookahead (see lookahead.py) runs them ahead, concurrently,
+       and leaves the rows in self.prefetched under the key.
+    """
+    def lookupKeys(self, lines, sep='\t'):
+        return []
+
+    def lookup(self, cursor, key):
+        return ()
+
+    def annotate(self, fields):
+        return fields
+
+    def getCounts(self):
+        return dict([(name, getattr(self, name))
+            for name in self.counters + CACHE_COUNTERS])
+
+    """Adds counts from getCounts of another annotator of the same stage,
+       e.g. one that annotated a different part of the input. Only what it
+       counted past base, the counts of a fresh annotator, is added.
+    """
+    def addCounts(self, counts, base=None):
+        for name in self.counters + CACHE_COUNTERS:
+            start = base[name] if base is not None else 0
+            setattr(self, name, getattr(self, name) + counts[name] - start)
+
+    def writeLog(self, fh_log):
+        pass
+
+    """Name of the stage in the annotation cache
+    """
+    def cacheName(self):
+        return self.__class__.__name__ + ':' + str(getattr(self, 'table', ''))
+
+    """Reference tables annotate reads, for the version of the stage (see
+       stageVersion in annotcache.py)
+    """
+    def tables(self):
+        table = getattr(self, 'table', '')
+        return [table] if table else []
+
+    def cacheVariant(self, fields):
+        return '\t'.join([fields[i].strip() for i in self.inds])
+
+    """What annotate depends on besides the variant: here, the shape of
+       INFO it adds to
+    """
+    def cacheContext(self, fields):
+        info = fields.getInfo()
+        return ''.join([str(int(x)) for x in (info.isMissing(),
+            info.startswith('.;'), info.endswith(';'))])
+
+    """What annotate added to fields, as a cache entry; None when it cannot
+       be replayed on another record with the same context
+    """
+    def contribution(self, before, counts, fields, result):
+        joined = result is not fields
+        after = str(result.getInfo())
+        if joined:
+            after = after[len(self.joinSep) - 1:]
+
+        entry = {}
+        if after.startswith(before):
+            entry['info'] = after[len(before):]
+        elif (before == '.'):
+            entry['set'] = after
+        else:
+            return None
+        if joined:
+            entry['joined'] = True
+        if self.cacheId:
+            entry['id'] = result[2]
+        entry['counts'] = dict([(name, getattr(self, name) - counts[name])
+            for name in self.counters if getattr(self, name) != counts[name]])
+        return entry
+
+    """Applies a cache entry from contribution to fields
+    """
+    def replay(self, fields, entry):
+        if 'id' in entry:
+            fields[2] = entry['id']
+        if 'set' in entry:
+            fields.getInfo().set(entry['set'])
+        elif (len(entry['info']) > 0):
+            fields.getInfo().append(entry['info'])
+        for name in entry['counts']:
+            setattr(self, name, getattr(self, name) + entry['counts'][name])
+        if entry.get('joined'):
+            fields = fields.joinedBy(self.joinSep)
+        return fields
+
+    def writeCacheLog(self, fh_log):
+        total = self.cache_hits + self.cache_misses
+        if (total > 0):
+            ratio = (self.cache_hits / float(total)) * 100
+            fh_log.write(f"Annotation cache ({self.cacheName()}): " + \
+                f"{str(self.cache_hits)} of {str(total)} hits ({ratio:.1f}%)\n")
+
+
+"""Base class for annotators of the overlap tables
+   Only '##' meta lines and the column header line are passed through.
+   With an IntervalIndex of the table (see intervals.py) overlaps are
+   answered in memory instead of by a query per record. Windows handed to
+   prefetch are then resolved per chromosome in one vectorized pass (see
+   overlaps.py).
+"""
+class OverlapAnnotator(RecordAnnotator):
+    chromName = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+    counters = ('var_count', 'line_count')
+
+    def __init__(self, cursor, format='vcf', table='', index=None,
+        store=None, bin_queries=False):
+        RecordAnnotator.__init__(self, cursor, format=format, store=store,
+            bin_queries=bin_queries)
+        self.table = table
+        self.index = index
+        self.prefetched = {}
+        self.var_count = 0
+        self.line_count = 0
+
+    def isRecord(self, line):
+        if line.startswith('##'):
+            return False
+        if (line.startswith('CHROM') or line.startswith('#CHROM')):
+            return False
+        return True
+
+    """Chromosome name as stored in the table
+    """
+    def getChrom(self, chr):
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return chr
+
+    def prefetch(self, lines, sep='\t'):
+        self.prefetched = {}
+        if (self.index is None) and (self.store is None):
+            return
+
+        positions = {}
+        for line in lines:
+            fields = line.split(sep, self.inds[1] + 1)
+            chr = self.getChrom(fields[self.inds[0]].strip())
+            positions.setdefault(chr, set()).add(int(fields[self.inds[1]]))
+
+        for chr in positions:
+            pos = sorted(positions[chr])
+            if self.index is not None:
+                found = self.index.overlapsBatch(chr, pos)
+            else:
+                found = self.store.overlappingBatch(self.table, chr, pos)
+            for i in range(0, len(pos)):
+                self.prefetched[(chr, pos[i])] = found[i]
+
+    """Rows of the table with startName <= pos <= endName
+    """
+    def getOverlapRows(self, chr, pos):
+        key = (chr, int(pos))
+        if key in self.prefetched:
+            return self.prefetched[key]
+        if self.index is not None:
+            return self.index.overlaps(chr, pos)
+        if self.store is not None:
+            return self.store.overlapping(self.table, chr, int(pos))
+        return self.queryOverlapRows(self.cursor, chr, pos)
+
+    def queryOverlapRows(self, cursor, chr, pos):
+        sql = 'select * from ' + self.table + ' where ' + self.chromName + \
+            '="' + str(chr) + '" AND ' + \
+            self.binClause(self.table, pos, pos, cursor=cursor) + \
+            '(' + self.startName + ' <= ' + str(pos) + ' AND ' + str(pos) + \
+            ' <= ' + self.endName + ')' + \
+            intervals.orderClause(self.table) + ';'
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+    # Without an index or a store every record is a query
+    def lookupKeys(self, lines, sep='\t'):
+        if (self.index is not None) or (self.store is not None):
+            return []
+        keys = []
+        for line in lines:
+            if self.isRecord(line):
+                fields = line.split(sep, self.inds[1] + 1)
+                keys.append((self.getChrom(fields[self.inds[0]].strip()),
+                    int(fields[self.inds[1]])))
+        return keys
+
+    def lookup(self, cursor, key):
+        return self.queryOverlapRows(cursor, key[0], key[1])
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+
+"""Connection a stage runs against, borrowed from the process-wide pool;
+   with a ReferenceStore no database connection is opened
+"""
+def stageConnect(store=None):
+    if store is not None:
+        return store.connect()
+    return u.db_pool_connect()
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+"""Runs annotator on fields through an AnnotationCache (see annotcache.py):
+   a stage that has seen the variant in the same context replays what it
+   added then instead of looking it up again
+"""
+def annotateCached(annotator, fields, cache):
+    stage = annotator.cacheName()
+    variant = annotator.cacheVariant(fields)
+    context = annotator.cacheContext(fields)
+    entry = cache.get(stage, variant, context)
+    if entry is not None:
+        annotator.cache_hits = annotator.cache_hits + 1
+        return annotator.replay(fields, entry)
+
+    annotator.cache_misses = annotator.cache_misses + 1
+    before = str(fields.getInfo())
+    counts = annotator.getCounts()
+    result = annotator.annotate(fields)
+    entry = annotator.contribution(before, counts, fields, result)
+    if entry is not None:
+        cache.put(stage, variant, context, entry)
+    return result
+
+
+"""Runs one (stripped) line through a list of annotators
+   The record is parsed once into a VcfRecord (see vcfrecord.py) that is
+   handed from one annotator to the next. It is only re-parsed when a
+   separate pass, which strips and splits the line it reads, would have
+   seen different fields.
+"""
+def annotateLine(line, annotators, sep='\t', cache=None):
+    fields = None
+    for annotator in annotators:
+        if not annotator.isRecord(line):
+            continue
+
+        if fields is None:
+            fields = vcfrecord.VcfRecord(line, sep)
+            if cache is not None:
+                cache.startRecord(fields)
+        elif (sep != '\t') or (len(fields.lastColumn()) == 0) or \
+            fields.lastColumn()[-1].isspace():
+            fields = vcfrecord.VcfRecord(fields.toLine().strip(), sep)
+
+        if cache is not None:
+            fields = annotateCached(annotator, fields, cache)
+        else:
+            fields = annotator.annotate(fields)
+
+    if fields is None:
+        return line
+    if cache is not None:
+        cache.recordDone()
+    return fields.toLine()
+
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+"""Lines of a window the stage still has to prefetch: with a cache,
+   variants it has an entry for are left out
+"""
+def linesToPrefetch(annotator, lines, sep='\t', cache=None):
+    lines = [l for l in lines if annotator.isRecord(l)]
+    if (cache is None) or (len(lines) == 0):
+        return lines
+
+    inds = annotator.inds
+    variants = []
+    for l in lines:
+        cols = l.split(sep, max(inds) + 1)
+        variants.append('\t'.join([cols[i].strip() for i in inds]))
+    known = cache.known(annotator.cacheName(), variants)
+    return [lines[i] for i in range(0, len(lines)) if variants[i] not in known]
+
+
+"""Annotates a window of (stripped) lines: the window is prefetched by
+   every annotator, then its lines are annotated one by one. ahead holds
+   the lookups a Lookahead ran for the window (see lookahead.py).
+"""
+def annotateBatch(lines, annotators, sep='\t', cache=None, ahead=None):
+    for annotator in annotators:
+        annotator.prefetch(linesToPrefetch(annotator, lines, sep=sep,
+            cache=cache), sep=sep)
+        if ahead is not None:
+            ahead.fill(annotator)
+    return [annotateLine(line, annotators, sep=sep, cache=cache)
+        for line in lines]
+
+
+"""Reads the input once, runs every line through the annotators and
+   writes the output once. Counts are written to the log at the end,
+   in annotator order. With batch_size the input is read in windows of
+   batch_size lines and each window is prefetched before it is annotated.
+   With a Lookahead, the database lookups of the next window run while
+   the current one is annotated. A gzip or bgzip infile is read as is;
+   with compress the output is written as BGZF (see bgzf.py). Given a
+   source (see ingest.py), the input is read from its stream instead.
+"""
+def annotateFile(infile, outfile, annotators, logfile=None, logmode='a',
+    sep='\t', batch_size=None, cache=None, lookahead=None, compress=False,
+    source=None):
+
+    if source is not None:
+        fh = source.open()
+    else:
+        fh = bgzf.openText(infile)
+    fh_out = bgzf.openText(outfile, "w", compress=compress)
+
+    if lookahead is not None:
+        current = None
+        for batch in fu.readBatches(fh, batch_size or lookahead.depth):
+            lines = [line.strip() for line in batch]
+            ahead = lookahead.submit(annotators, lines, sep=sep, cache=cache)
+            if current is not None:
+                for line in annotateBatch(current[0], annotators, sep=sep,
+                    cache=cache, ahead=current[1]):
+                    fh_out.write(line + '\n')
+            current = (lines, ahead)
+        if current is not None:
+            for line in annotateBatch(current[0], annotators, sep=sep,
+                cache=cache, ahead=current[1]):
+                fh_out.write(line + '\n')
+    elif batch_size:
+        for batch in fu.readBatches(fh, batch_size):
+            lines = [line.strip() for line in batch]
+            for line in annotateBatch(lines, annotators, sep=sep, cache=cache):
+                fh_out.write(line + '\n')
+    else:
+        for line in fh:
+            fh_out.write(annotateLine(line.strip(), annotators, sep=sep,
+                cache=cache) + '\n')
 
+    fh.close()
+    fh_out.close()
+    if cache is not None:
+        cache.flush()
+
+    if logfile is not None:
+        fh_log = open(logfile, logmode)
+        for annotator in annotators:
+            annotator.writeLog(fh_log)
+            if (cache is not None) and cache.reportHits:
+                annotator.writeCacheLog(fh_log)
+        fh_log.close()
+
+
+"""Annotates variants found in dbSNP
+   Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+   Windows handed to prefetch are resolved with one query per chromosome;
+   records outside a prefetched window are looked up one at a time.
+   With a PointIndex of the table (see intervals.py) records are looked up
+   in memory. Otherwise, with a BloomFilter of the table (see bloom.py),
+   records the filter rules out are not looked up in the database.
+"""
+class DbSnpAnnotator(RecordAnnotator):
+    counters = ('var_count', 'linenum', 'filter_checks', 'filter_skipped')
+    cacheId = True
+
+    def __init__(self, cursor, format='vcf', varclass='SNV', store=None,
+        filter=None, index=None):
+        RecordAnnotator.__init__(self, cursor, format=format, store=store)
+        self.varclass = varclass
+        self.filter = filter
+        self.index = index
+        self.var_count = 0
+        self.linenum = 1
+        self.filter_checks = 0
+        self.filter_skipped = 0
+        self.prefetched = {}
+
+    def cacheName(self):
+        return 'DbSnpAnnotator:' + self.varclass
+
+    def tables(self):
+        return ['dbSNP']
+
+    def getKey(self, fields):
+        inds = self.inds
+
+        chr = fields[inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+
+        pos = fields[inds[1]].strip()
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        return chr, pos, ref
+
+    """False when the filter rules out ref and its complement at pos
+    """
+    def mayBeInDbSnp(self, chr, pos, ref, compRef):
+        if self.filter is None:
+            return True
+        return self.filter.mayContain(
+            bloom.dbSnpKey(chr, pos, ref, self.varclass)) or \
+            self.filter.mayContain(
+            bloom.dbSnpKey(chr, pos, compRef, self.varclass))
+
+    def prefetch(self, lines, sep='\t'):
+        if (self.store is not None) or (self.index is not None):
+            return
+
+        positions = {}
+        for line in lines:
+            chr, pos, ref = self.getKey(line.split(sep, self.inds[3] + 1))
+            if self.mayBeInDbSnp(chr, pos, ref, getComplementary(ref)):
+                positions.setdefault(chr, set()).add(int(pos))
+
+        self.prefetched = {}
+        for chr in positions:
+            for pos in positions[chr]:
+                self.prefetched[(chr, pos)] = []
+
+            sql = 'select CHR, POS, REF, dbSNP.* from dbSNP where CHR=%s ' + \
+                'AND INFO=%s AND POS in (' + \
+                ','.join(['%s'] * len(positions[chr])) + ');'
+            self.cursor.execute(sql,
+                [chr, self.varclass] + sorted(positions[chr]))
+
+            for row in self.cursor.fetchall():
+                key = (chr, int(row[1]))
+                if key in self.prefetched:
+                    self.prefetched[key].append(row)
+
+    def getRows(self, chr, pos, ref, compRef):
+        # Same match on REF as the query below, which is case-insensitive
+        refs = [str(ref).upper(), str(compRef).upper()]
+
+        if self.store is not None:
+            refIdx = self.store.columnIndex('dbSNP', 'REF')
+            infoIdx = self.store.columnIndex('dbSNP', 'INFO')
+            return [row for row in self.store.equal('dbSNP', chr, int(pos))
+                if str(row[refIdx]).upper() in refs and
+                str(row[infoIdx]).upper() == self.varclass.upper()]
+
+        if self.index is not None:
+            refIdx = self.index.columnIndex('REF')
+            infoIdx = self.index.columnIndex('INFO')
+            return [row for row in self.index.get(chr, pos)
+                if str(row[refIdx]).upper() in refs and
+                str(row[infoIdx]).upper() == self.varclass.upper()]
+
+        if self.filter is not None:
+            self.filter_checks = self.filter_checks + 1
+            if not self.mayBeInDbSnp(chr, pos, ref, compRef):
+                self.filter_skipped = self.filter_skipped + 1
+                return ()
+
+        key = (chr, int(pos))
+        if key in self.prefetched:
+            return [row[3:] for row in self.prefetched[key]
+                if str(row[2]).upper() in refs]
+
+        sql = 'select * from dbSNP where CHR="' + str(chr) + \
+            '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
+            '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
+            self.varclass + '" ;'
+        self.cursor.execute(sql)
+        return self.cursor.fetchall()
+
+    def annotate(self, fields):
+        varclass = self.varclass
+
+        chr, pos, ref = self.getKey(fields)
+        compRef = getComplementary(ref)
+        rows = self.getRows(chr, pos, ref, compRef)
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(rows) > 0):
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            info = fields.getInfo()
+            if info.isMissing():
+                info.set('DB' + maf_str)
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+                info.append(';DB;VC=' + varclass + maf_str)
 
-            linenum = linenum + 1
+            fields[2] = str(';'.join(rsids))
 
-        else:
-            fh_out.write(line + '\n')
+        self.linenum = self.linenum + 1
+        return fields
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def writeLog(self, fh_log):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
 
+        if self.filter is not None:
+            line = f"dbSNP filter: {self.filter.sizeBytes() // 1024} kB, " + \
+                f"~{self.filter.fpRate() * 100:.2f}% false positives, " + \
+                f"{str(self.filter_skipped)} of {str(self.filter_checks)} " + \
+                "lookups skipped"
+            print(line)
+            fh_log.write(line + "\n")
+
+
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=None, store=None, filter=None,
+    index=None, cache=None, lookahead=None):
+
+    conn = stageConnect(store)
+    annotator = DbSnpAnnotator(conn.cursor(), format=format, varclass=varclass,
+        store=store, filter=filter, index=index)
+    annotateFile(vcf, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', logmode='w', sep=sep,
+        batch_size=batch_size, cache=cache, lookahead=lookahead)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """NOTE: all isoforms are collapsed in one record
     1. chrom_pos_equal_base
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
+   Windows handed to prefetch are resolved with one query per table and
+   chromosome; a table is only queried for the positions the tables before
+   it left without a match.
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
+class BigRefGeneAnnotator(RecordAnnotator):
+    def __init__(self, cursor, format='vcf', store=None):
+        RecordAnnotator.__init__(self, cursor, format=format, store=store)
+        self.prefetched = {}
+
+    def tables(self):
+        return ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+            'chrom_pos_unequal']
+
+    def getKey(self, fields):
+        inds = self.inds
+
+        chr = fields[inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+
+        pos = fields[inds[1]].strip()
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
+        return chr, pos, ref, alt
+
+    """Rows of chrom_pos_equal_base with the alleles or their complements;
+       compared case-insensitively, like the query
+    """
+    def matchBase(self, rows, refIdx, altIdx, ref, alt, compRef, compAlt):
+        pairs = [(str(ref).upper(), str(alt).upper()),
+            (str(compRef).upper(), str(compAlt).upper())]
+        return [row for row in rows
+            if (str(row[refIdx]).upper(), str(row[altIdx]).upper()) in pairs]
+
+    """Runs sql once for the sorted positions and returns the rows of each
+       position, in the order the query returned them
+    """
+    def fetchByPosition(self, sql, args, positions, startName, endName=None):
+        self.cursor.execute(sql, args)
+        rows = self.cursor.fetchall()
+        startIdx = intervals.getColumnIndex(self.cursor, startName)
+        endIdx = None
+        if endName is not None:
+            endIdx = intervals.getColumnIndex(self.cursor, endName)
+
+        found = dict([(pos, []) for pos in positions])
+        for row in rows:
+            if endIdx is None:
+                if int(row[startIdx]) in found:
+                    found[int(row[startIdx])].append(row)
+            else:
+                # positions are sorted
+                lo = bisect_left(positions, int(row[startIdx]))
+                hi = bisect_right(positions, int(row[endIdx]))
+                for pos in positions[lo:hi]:
+                    found[pos].append(row)
+        return found
+
+    def prefetch(self, lines, sep='\t'):
+        if self.store is not None:
+            return
+
+        variants = {}
+        for line in lines:
+            chr, pos, ref, alt = self.getKey(line.split(sep, self.inds[3] + 1))
+            variants.setdefault(chr, {}).setdefault(int(pos), set()).add(
+                (ref, alt, getComplementary(ref), getComplementary(alt)))
+
+        self.prefetched = {}
+        for chr in variants:
+            positions = sorted(variants[chr])
+            for pos in positions:
+                self.prefetched[(chr, pos)] = [None, None, None]
+
+            sql = 'select * from chrom_pos_equal_base where CHR=%s ' + \
+                'AND start in (' + ','.join(['%s'] * len(positions)) + ');'
+            found = self.fetchByPosition(sql, [chr] + positions, positions,
+                'start')
+            refIdx = intervals.getColumnIndex(self.cursor, 'haplotypeReference')
+            altIdx = intervals.getColumnIndex(self.cursor, 'haplotypeAlternate')
+            self.baseColumns = (refIdx, altIdx)
+            for pos in positions:
+                self.prefetched[(chr, pos)][0] = found[pos]
+
+            # Positions with a variant the first table does not match
+            positions = [pos for pos in positions
+                if any([len(self.matchBase(found[pos], refIdx, altIdx, *v)) == 0
+                for v in variants[chr][pos]])]
+            if (len(positions) == 0):
+                continue
+
+            sql = 'select * from chrom_pos_equal_nobase where CHR=%s ' + \
+                'AND start in (' + ','.join(['%s'] * len(positions)) + ');'
+            found = self.fetchByPosition(sql, [chr] + positions, positions,
+                'start')
+            for pos in positions:
+                self.prefetched[(chr, pos)][1] = found[pos]
+
+            positions = [pos for pos in positions if len(found[pos]) == 0]
+            if (len(positions) == 0):
+                continue
+
+            sql = 'select * from chrom_pos_unequal where CHR=%s AND (' + \
+                ' OR '.join(['(start <= %s AND %s <= end)'] * len(positions)) + \
+                ');'
+            args = [chr]
+            for pos in positions:
+                args = args + [pos, pos]
+            found = self.fetchByPosition(sql, args, positions, 'start', 'end')
+            for pos in positions:
+                self.prefetched[(chr, pos)][2] = found[pos]
+
+    """Rows of the first table, in order of precedence, with a match
+    """
+    def getRows(self, chr, pos, ref, alt, compRef, compAlt):
+        if self.store is not None:
+            return self.getStoreRows(chr, pos, ref, alt, compRef, compAlt)
+
+        sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + \
+            ' AND ((haplotypeReference="' + str(ref) + \
+            '" AND haplotypeAlternate ="' + str(alt) + \
+            '") OR (haplotypeReference="' + str(compRef) + \
+            '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+
+        sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + ';'
+
+        sql3 = 'select * from chrom_pos_unequal where CHR="' + \
+            str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
+            str(pos) + ' <= end ;'
+
+        prefetched = self.prefetched.get((chr, int(pos)))
+        sqls = [sql1, sql2, sql3]
+        for i in range(0, len(sqls)):
+            if (prefetched is not None) and (prefetched[i] is not None):
+                rows = prefetched[i]
+                if (i == 0):
+                    refIdx, altIdx = self.baseColumns
+                    rows = self.matchBase(rows, refIdx, altIdx, ref, alt,
+                        compRef, compAlt)
+            else:
+                self.cursor.execute(sqls[i])
+                rows = self.cursor.fetchall()
             if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                fh_out.write(line + '\n')
+                return rows
+        return ()
 
-            vcf_linenum = vcf_linenum + 1
+    def getStoreRows(self, chr, pos, ref, alt, compRef, compAlt):
+        store = self.store
+        pos = int(pos)
 
-        else:
-            fh_out.write(line + '\n')
+        refIdx = store.columnIndex('chrom_pos_equal_base', 'haplotypeReference')
+        altIdx = store.columnIndex('chrom_pos_equal_base', 'haplotypeAlternate')
+        rows = self.matchBase(store.equal('chrom_pos_equal_base', chr, pos),
+            refIdx, altIdx, ref, alt, compRef, compAlt)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if (len(rows) == 0):
+            rows = store.equal('chrom_pos_equal_nobase', chr, pos)
+        if (len(rows) == 0):
+            rows = store.overlapping('chrom_pos_unequal', chr, pos)
+        return rows
 
+    def annotate(self, fields):
+        chr, pos, ref, alt = self.getKey(fields)
 
-"""Get information about location in gene structures
-"""
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
 
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+        # First table with a match wins
+        rows = self.getRows(chr, pos, ref, alt, compRef, compAlt)
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
+        if (len(rows) > 0):
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+            info = fields.getInfo()
+            info.append(';' + ';'.join(m))
+            if info.startswith(".;"):
+                info.set(str(info).replace('.;', '', 1))
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
+        return fields
 
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    batch_size=None, store=None, cache=None, lookahead=None):
+    conn = stageConnect(store)
+    annotator = BigRefGeneAnnotator(conn.cursor(), format=format, store=store)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator], sep=sep,
+        batch_size=batch_size, cache=cache, lookahead=lookahead)
+    conn.close()
 
-                    cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+# Parsed transcripts, most recently used last
+TRANSCRIPT_CACHE_SIZE = 100000
+_transcripts = OrderedDict()
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+"""Exon structure of a transcript with its exon starts and ends as ints
+   Exons are in transcript order, so the exons over a position are found
+   by binary search; lists that are not sorted are scanned.
+"""
+class Transcript(object):
+    def __init__(self, exonCount, exonStarts, exonEnds):
+        self.exonCount = exonCount
+        exonsSt = str(exonStarts.decode('utf-8')).split(',')
+        exonsEn = str(exonEnds.decode('utf-8')).split(',')
+        self.starts = [int(exonsSt[e]) for e in range(0, exonCount)]
+        self.ends = [int(exonsEn[e]) for e in range(0, exonCount)]
+        self.sorted = all([self.starts[e] <= self.starts[e + 1] and
+            self.ends[e] <= self.ends[e + 1] for e in range(0, exonCount - 1)])
+
+    """Indexes of the exons with start <= pos <= end, in exon order
+    """
+    def getExons(self, pos):
+        if self.sorted:
+            return range(bisect_left(self.ends, pos),
+                bisect_right(self.starts, pos))
+        return [e for e in range(0, self.exonCount)
+            if u.isBetween(pos, self.starts[e], self.ends[e])]
+
+    """Exon number as read along the strand
+    """
+    def exonNumber(self, e, strand):
+        if (strand == '-'):
+            return self.exonCount - e
+        return e + 1
+
+
+"""Transcript of a refGene row, from the cache of this process
+"""
+def getTranscript(row):
+    key = (row[8], row[9], row[10])
+    transcript = _transcripts.get(key)
+    if transcript is None:
+        transcript = Transcript(int(row[8]), row[9], row[10])
+        _transcripts[key] = transcript
+        if (len(_transcripts) > TRANSCRIPT_CACHE_SIZE):
+            _transcripts.popitem(last=False)
+    else:
+        _transcripts.move_to_end(key)
+    return transcript
 
-            linenum = linenum + 1
 
-        else:
-            fh_out.write(line + '\n')
+"""Get information about location in gene structures
+"""
+class GeneAnnotator(RecordAnnotator):
+    counters = ('interGenic_count', 'cds_count', 'utr3_count', 'utr5_count',
+        'intronic_count', 'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count', 'cpg_lookups',
+        'cpg_queries')
+
+    def __init__(self, cursor, format='vcf', table='refGene',
+        promoter_offset=500, store=None, bin_queries=False):
+        RecordAnnotator.__init__(self, cursor, format=format, store=store,
+            bin_queries=bin_queries)
+        self.table = table
+        self.promoter_offset = promoter_offset
+
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+        # Promoter regions are checked against an in-memory cpgIslandExt
+        self.cpgIslands = None
+        if (store is None) and (cursor is not None):
+            self.cpgIslands = intervals.loadCpgIslands(cursor)
+        self.cpg_lookups = 0
+        self.cpg_queries = 0
+        self.prefetched = {}
+
+    # Intronic variants are counted by the positionType already in INFO
+    def cacheContext(self, fields):
+        return RecordAnnotator.cacheContext(self, fields) + '\t' + \
+            str(fields.getInfo().get('positionType'))
+
+    def tables(self):
+        return [self.table, 'cpgIslandExt']
+
+    """With a ReferenceStore, transcripts of a window are resolved per
+       chromosome in one vectorized pass
+    """
+    def prefetch(self, lines, sep='\t'):
+        self.prefetched = {}
+        if self.store is None:
+            return
+
+        positions = {}
+        for line in lines:
+            fields = line.split(sep, self.inds[1] + 1)
+            chr = fields[self.inds[0]].strip()
+            if not chr.startswith("chr"):
+                chr = "chr" + chr
+            positions.setdefault(chr, set()).add(int(fields[self.inds[1]]))
+
+        for chr in positions:
+            pos = sorted(positions[chr])
+            found = self.store.overlappingBatch(self.table, chr, pos,
+                pad=int(self.promoter_offset))
+            for i in range(0, len(pos)):
+                self.prefetched[(chr, pos[i])] = found[i]
+
+    """Transcripts with txStart - promoter_offset <= pos <= txEnd + promoter_offset
+    """
+    def getTranscripts(self, chr, pos):
+        key = (chr, int(pos))
+        if key in self.prefetched:
+            return self.prefetched[key]
+        if self.store is not None:
+            return self.store.overlapping(self.table, chr, int(pos),
+                pad=int(self.promoter_offset))
+        return self.queryTranscripts(self.cursor, chr, pos)
+
+    def queryTranscripts(self, cursor, chr, pos):
+        sql = 'select * from ' + self.table + ' where chrom="' + str(chr) + \
+            '" AND ' + self.binClause(self.table,
+            int(pos) - int(self.promoter_offset),
+            int(pos) + int(self.promoter_offset), cursor=cursor) + \
+            '(txStart - ' + str(self.promoter_offset) +') <= ' + \
+            str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
+            str(self.promoter_offset) +')' + \
+            intervals.orderClause(self.table) + ';'
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+    def lookupKeys(self, lines, sep='\t'):
+        if self.store is not None:
+            return []
+        keys = []
+        for line in lines:
+            if self.isRecord(line):
+                fields = line.split(sep, self.inds[1] + 1)
+                chr = fields[self.inds[0]].strip()
+                if not chr.startswith("chr"):
+                    chr = "chr" + chr
+                keys.append((chr, int(fields[self.inds[1]])))
+        return keys
+
+    def lookup(self, cursor, key):
+        return self.queryTranscripts(cursor, key[0], key[1])
+
+    """First CpG island (chrom, chromStart, chromEnd, name) over pos, or None
+    """
+    def getCpgIsland(self, chr, pos):
+        self.cpg_lookups = self.cpg_lookups + 1
+        if self.cpgIslands is not None:
+            rows = self.cpgIslands.overlaps(chr, pos)
+            if (len(rows) > 0):
+                return rows[0]
+            return None
+        if self.store is not None:
+            rows = self.store.overlapping('cpgIslandExt', chr, int(pos),
+                columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+            if (len(rows) > 0):
+                return rows[0]
+            return None
+
+        sql = 'select chrom, chromStart, chromEnd, name from ' + \
+            'cpgIslandExt where chrom="' + str(chr) + '" AND ' + \
+            self.binClause('cpgIslandExt', pos, pos) + \
+            '(chromStart <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= chromEnd)' + \
+            intervals.orderClause('cpgIslandExt') + ';'
+        self.cpg_queries = self.cpg_queries + 1
+        self.cursor.execute(sql)
+        return self.cursor.fetchone()
+
+    def annotate(self, fields):
+        inds = self.inds
+        promoter_offset = self.promoter_offset
+
+        chr = fields[inds[0]].strip()
+
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+
+        rows = self.getTranscripts(chr, pos)
+        info = []
+
+        if (len(rows) > 0):
+            cnt = 1
+            positionType = clean_mysql_chars(
+                fields.getInfo().get('positionType')).strip()
+            for row in rows:
+                #count location
+                if (positionType == 'intron'):
+                    self.intronic_count = self.intronic_count + 1
+                elif (positionType == 'non_coding_intron'):
+                    self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                elif (positionType == 'CDS'):
+                    self.cds_count = self.cds_count + 1
+                elif (positionType == 'non_coding_exon'):
+                    self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                elif (positionType == 'utr5'):
+                    self.utr5_count = self.utr5_count + 1
+                elif (positionType == 'utr3'):
+                    self.utr3_count = self.utr3_count + 1
+
+                txtStart = int(row[4])
+                txtEnd = int(row[5])
+                cdsStart = int(row[6])
+                cdsEnd = int(row[7])
+                exonCount = int(row[8])
+                transcript = getTranscript(row)
+                strand = str(row[3])
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for e in transcript.getExons(pos):
+                        exnum = transcript.exonNumber(e, strand)
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+                elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                    for e in transcript.getExons(pos):
+                        exnum = transcript.exonNumber(e, strand)
+                        exons.append("exon=" +  "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.exonic_count = self.exonic_count + 1
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif (u.isBetween(pos, promoter_plus, txtStart) and
+                    (strand == "+")):
+                    island = self.getCpgIsland(chr, pos)
+
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + \
+                            "".join(str(island[3]).split())
+                        self.promoter_count = self.promoter_count + 1
+
+                elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                    island = self.getCpgIsland(chr, pos)
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' +  \
+                            "".join(str(island[3]).split())
+                        self.promoter_count = self.promoter_count + 1
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+                else:
+                    region = ''
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row,
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+                cnt = cnt + 1
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+            str_info = ";".join(info)
+            fields.getInfo().append(';' + str_info)
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+        else:
+            fields.getInfo().append(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        return fields
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        print(f"In \'3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In \'3 UTR {str(self.utr3_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        print(f"In \'5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In \'5 UTR {str(self.utr5_count)}\n")
 
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
-                    else:
-                        region = ''
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-                    cnt = cnt + 1
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+        if (self.cpg_lookups > 0):
+            hitRate = (1 - self.cpg_queries / float(self.cpg_lookups)) * 100
+            line = f"cpgIslandExt: {str(self.cpg_lookups)} lookups, " + \
+                f"{hitRate:.1f}% answered without a query"
+            print(line)
+            fh_log.write(line + "\n")
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
 
-            linenum = linenum + 1
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t', store=None, bin_queries=False,
+    cache=None, lookahead=None):
 
-        else:
-            fh_out.write(line + '\n')
+    conn = stageConnect(store)
+    annotator = GeneAnnotator(conn.cursor(), format=format, table=table,
+        promoter_offset=promoter_offset, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
+    conn.close()
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+class ExonsEtAlAnnotator(GeneAnnotator):
+    def annotate(self, fields):
+        inds = self.inds
+        promoter_offset = self.promoter_offset
+
+        chr = fields[inds[0]].strip()
+
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+
+        rows = self.getTranscripts(chr, pos)
+        info = []
+        if (len(rows) > 0):
+            cnt = 1
+            for row in rows:
+                txtStart = int(row[4])
+                txtEnd = int(row[5])
+                cdsStart = int(row[6])
+                cdsEnd = int(row[7])
+                exonCount = int(row[8])
+                transcript = getTranscript(row)
+                strand = str(row[3])
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for e in transcript.getExons(pos):
+                        exnum = transcript.exonNumber(e, strand)
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                    if (len(exons) > 0):
+                        region='positionType=non_coding_exon;' + ";".join(exons)
+                    else:
+                        self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                        region = 'positionType=non_coding_intron'
+
+                elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                    self.cds_count = self.cds_count + 1
+                    for e in transcript.getExons(pos):
+                        exnum = transcript.exonNumber(e, strand)
+                        exons.append("exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.exonic_count = self.exonic_count + 1
+                    if (len(exons) > 0):
+                        region = 'positionType=CDS;' + ";".join(exons)
+                    else:
+                        self.intronic_count = self.intronic_count + 1
+                        region = 'positionType=CDS;' + 'intron'
+
+                elif (u.isBetween(pos, txtStart, cdsStart) and \
+                    (cdsStart < cdsEnd) and (strand == "+")):
+                    self.utr5_count = self.utr5_count + 1
+                    region = 'positionType=utr5'
+
+                elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                    (cdsStart < cdsEnd) (strand == "+")):
+                    self.utr3_count = self.utr3_count + 1
+                    region = 'positionType=utr3'
+
+                elif (u.isBetween(pos, cdsEnd, txtEnd) and
+                    (cdsStart < cdsEnd) (strand == "-")):
+                    self.utr5_count = self.utr5_count + 1
+                    region = 'positionType=utr5'
+
+                elif (u.isBetween(pos, txtStart, cdsStart) and \
+                    (cdsStart < cdsEnd) and (strand == "-")):
+                    self.utr3_count = self.utr3_count + 1
+                    region = 'positionType=utr3'
+
+                elif (u.isBetween(pos, promoter_plus, txtStart) and \
+                    (strand == "+")):
+                    island = self.getCpgIsland(chr, pos)
+
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + \
+                            "".join(str(island[3]).split())
+                        self.promoter_count = self.promoter_count + 1
+
+                elif (u.isBetween(pos, txtEnd, promoter_minus) and \
+                    (strand == "-")):
+                    island = self.getCpgIsland(chr, pos)
+
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + \
+                        "".join(str(island[3]).split())
+                        self.promoter_count = self.promoter_count + 1
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+                else:
+                    region = ''
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+                if (region != ''):
+                    info.append(collapseGeneNames(
+                        row=row, indices=indicesKnownGenes,
+                        region=region, cnt=cnt))
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+                cnt = cnt + 1
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+            str_info = ";".join(info)
+            fields.getInfo().append(';' + str_info)
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        else:
+            fields.getInfo().append(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        return fields
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t', store=None, bin_queries=False,
+    cache=None, lookahead=None):
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
+    conn = stageConnect(store)
+    annotator = ExonsEtAlAnnotator(conn.cursor(), format=format, table=table,
+        promoter_offset=promoter_offset, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
     conn.close()
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
+class TfbsConsSitesAnnotator(OverlapAnnotator):
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    # Sites are looked up in one table per chromosome; only a Lookahead
+    # resolves them ahead
+    def prefetch(self, lines, sep='\t'):
+        self.prefetched = {}
+
+    def tables(self):
+        return ['tfbsConsSites' + c for c in self.allowed_chrom]
+
+    """Sites (chrom, chromStart, chromEnd, name) over pos in the table of
+       chromosome chrIndex
+    """
+    def getSites(self, chrIndex, pos):
+        key = (chrIndex, int(pos))
+        if key in self.prefetched:
+            return self.prefetched[key]
+        if self.store is not None:
+            return self.store.overlapping('tfbsConsSites' + chrIndex, '',
+                int(pos), columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+        return self.querySites(self.cursor, chrIndex, pos)
+
+    def querySites(self, cursor, chrIndex, pos):
+        table = 'tfbsConsSites' + chrIndex
+        sql = 'select chrom, chromStart, chromEnd, name ' + \
+            'from ' + table + \
+            ' where  ' + self.binClause(table, pos, pos, cursor=cursor) + \
+            'chromStart <= ' + str(pos) + ' AND ' + \
+            str(pos) + ' <= chromEnd' + intervals.orderClause(table) + ';'
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+    def lookupKeys(self, lines, sep='\t'):
+        if self.store is not None:
+            return []
+        keys = []
+        for line in lines:
+            if self.isRecord(line):
+                fields = line.split(sep, self.inds[1] + 1)
+                chrIndex = fields[self.inds[0]].strip().replace('chr', '')
+                if (chrIndex in self.allowed_chrom):
+                    keys.append((chrIndex, int(fields[self.inds[1]])))
+        return keys
+
+    def lookup(self, cursor, key):
+        return self.querySites(cursor, key[0], key[1])
+
+    def annotate(self, fields):
+        inds = self.inds
+
+        chr = fields[inds[0]].strip()
+        # For some reason this table has no "chr" preceeding number
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos=fields[inds[1]].strip()
+        chrIndex=chr.replace('chr', '')
+
+        if (chrIndex in self.allowed_chrom):
+            rows = self.getSites(chrIndex, pos)
+            records = []
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+            if (len(rows) > 0):
+                self.line_count = self.line_count + 1
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+                for row in rows:
+                    self.var_count = self.var_count + 1
+                    t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                        str(row[1]) + '.' + str(row[2])
+                    t = t.strip()
+                    records.append('tfbsRegion' + '=' + t)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+                fields.getInfo().add(';'.join(records))
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+        return fields
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t', store=None, bin_queries=False,
+    cache=None, lookahead=None):
 
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+    conn = stageConnect(store)
+    annotator = TfbsConsSitesAnnotator(conn.cursor(), format=format,
+        table=table, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
+    conn.close()
 
-                    fh_out.write('\t'.join(fields) + '\n')
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+"""Overlap with GadAll table
+"""
+class GadAllAnnotator(OverlapAnnotator):
+    chromName = 'chromosome'
+    # Annotated records have always been written with '\t '
+    joinSep = '\t '
+
+    # For some reason this table has no "chr" preceeding number
+    def getChrom(self, chr):
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+        return chr
+
+    def annotate(self, fields):
+        inds = self.inds
+        table = self.table
+
+        chr = self.getChrom(fields[inds[0]].strip())
+
+        pos = fields[inds[1]].strip()
+
+        rows = self.getOverlapRows(chr, pos)
+        records = []
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(table) + '=' + str(row[3]))
+            fields.getInfo().add(';'.join(records))
+            fields = fields.joinedBy(self.joinSep)
+
+        return fields
+
+
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
+    tmpextout='.1', sep='\t', index=None, store=None, bin_queries=False,
+    cache=None, lookahead=None):
+
+    conn = stageConnect(store)
+    annotator = GadAllAnnotator(conn.cursor(), format=format, table=table,
+        index=index, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
+    conn.close()
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
 
-        linenum = linenum + 1
+""" Overlap with gwasCatalog table """
+class GwasCatalogAnnotator(OverlapAnnotator):
+    # Rows are matched on chromEnd, not by overlap; only a Lookahead
+    # resolves them ahead
+    def prefetch(self, lines, sep='\t'):
+        self.prefetched = {}
+
+    """Rows with chromEnd = pos; index is a PointIndex of the table
+    """
+    def getRows(self, chr, pos):
+        key = (chr, int(pos))
+        if key in self.prefetched:
+            return self.prefetched[key]
+        if self.index is not None:
+            return self.index.get(chr, pos)
+        if self.store is not None:
+            return self.store.equal(self.table, chr, int(pos))
+        return self.queryRows(self.cursor, chr, pos)
+
+    def queryRows(self, cursor, chr, pos):
+        sql = 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND ' + \
+            self.binClause(self.table, pos, pos, cursor=cursor) + \
+            'chromEnd = ' + str(pos) + intervals.orderClause(self.table) + ';'
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+    def lookup(self, cursor, key):
+        return self.queryRows(cursor, key[0], key[1])
+
+    def annotate(self, fields):
+        inds = self.inds
+        table = self.table
+
+        chr = self.getChrom(fields[inds[0]].strip())
+
+        pos = fields[inds[1]].strip()
+
+        rows = self.getRows(chr, pos)
+        records = []
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                records.append(str(table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+            fields.getInfo().add(';'.join(records))
+
+        return fields
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t', index=None, store=None,
+    bin_queries=False, cache=None, lookahead=None):
+
+    conn = stageConnect(store)
+    annotator = GwasCatalogAnnotator(conn.cursor(), format=format,
+        table=table, index=index, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
-"""Overlap with GadAll table
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+class HugoAnnotator(OverlapAnnotator):
+    def annotate(self, fields):
+        inds = self.inds
+        table = self.table
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        chr = self.getChrom(fields[inds[0]].strip())
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        pos=fields[inds[1]].strip()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        rows = self.getOverlapRows(chr, pos)
+        records = []
 
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
 
-""" Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+            records_str = ','.join(records).replace(';', ',')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+            fields.getInfo().add(records_str)
+
+        return fields
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
+    tmpextin='', tmpextout='.1', sep='\t', index=None, store=None,
+    bin_queries=False, cache=None, lookahead=None):
+
+    conn = stageConnect(store)
+    annotator = HugoAnnotator(conn.cursor(), format=format, table=table,
+        index=index, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+class GenomicSuperDupsAnnotator(OverlapAnnotator):
+    def annotate(self, fields):
+        inds = self.inds
+        table = self.table
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        chr = self.getChrom(fields[inds[0]].strip())
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        pos = fields[inds[1]].strip()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        rows = self.getOverlapRows(chr, pos)
 
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            otherChrom = rows[0][7]
+            otherStart = rows[0][8]
+            otherEnd = rows[0][9]
+            fields.getInfo().append(';' + str(table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
 
-"""Overlap with segdup regions genomicSuperDups
-"""
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+        return fields
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t', index=None,
+    store=None, bin_queries=False, cache=None, lookahead=None):
 
+    conn = stageConnect(store)
+    annotator = GenomicSuperDupsAnnotator(conn.cursor(), format=format,
+        table=table, index=index, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class RefGeneOverlapAnnotator(OverlapAnnotator):
     colindex = 1
     colindex2 = 12
     name = 'name'
@@ -1131,273 +1645,163 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     startName = 'txStart'
     endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    def annotate(self, fields):
+        inds = self.inds
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
+        chr = self.getChrom(fields[inds[0]].strip())
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        pos = fields[inds[1]].strip()
+
+        overlapsWith = []
+        rows = self.getOverlapRows(chr, pos)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(self.name2 + '=' + \
+                    str(row[self.colindex2]) + ';' + self.name + '=' + \
+                    str(row[self.colindex]))
 
+            genes = ';'.join([str(x) for x in overlapsWith])
+            fields.getInfo().add(str(genes))
+
+        return fields
+
+
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
+    tmpextin='', tmpextout='.1', sep='\t', store=None, bin_queries=False,
+    cache=None, lookahead=None):
+
+    conn = stageConnect(store)
+    annotator = RefGeneOverlapAnnotator(conn.cursor(), format=format,
+        table=table, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
+class CytobandAnnotator(OverlapAnnotator):
+    def __init__(self, cursor, format='vcf', table='cytoBand', index=None,
+        store=None, bin_queries=False):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table,
+            index=index, store=store, bin_queries=bin_queries)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
 
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+    def annotate(self, fields):
+        inds = self.inds
+        table = self.table
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        chr = self.getChrom(fields[inds[0]].strip())
+
+        pos = fields[inds[1]].strip()
+
+        overlapsWith = []
+        rows = self.getOverlapRows(chr, pos)
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+
+            fields.getInfo().add(str(table) + '=' + str(cytoband))
+
+        return fields
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
+    tmpextin='', tmpextout='.1', sep='\t', index=None, store=None,
+    bin_queries=False, cache=None, lookahead=None):
+
+    conn = stageConnect(store)
+    annotator = CytobandAnnotator(conn.cursor(), format=format, table=table,
+        index=index, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+class CnvAnnotator(OverlapAnnotator):
+    def annotate(self, fields):
+        inds = self.inds
+        table = self.table
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+        chr = self.getChrom(fields[inds[0]].strip())
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        pos = fields[inds[1]].strip()
+        rows = self.getOverlapRows(chr, pos)
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            fields.getInfo().add(str(table) + '=' + str(isOverlap))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        return fields
 
+
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
+    tmpextin='', tmpextout='.1', sep='\t', index=None, store=None,
+    bin_queries=False, cache=None, lookahead=None):
+
+    conn = stageConnect(store)
+    annotator = CnvAnnotator(conn.cursor(), format=format, table=table,
+        index=index, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+class MiRNAAnnotator(OverlapAnnotator):
+    def annotate(self, fields):
+        inds = self.inds
 
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+        chr = self.getChrom(fields[inds[0]].strip())
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        pos = fields[inds[1]].strip()
+        rows = self.getOverlapRows(chr, pos)
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            row = rows[0]
+            t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+                str(row[2]) + '_' + str(row[3])
+            t = 'miRNAsites=' + t.strip()
+            fields.getInfo().add(t)
 
+        return fields
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t', index=None, store=None,
+    bin_queries=False, cache=None, lookahead=None):
+
+    conn = stageConnect(store)
+    annotator = MiRNAAnnotator(conn.cursor(), format=format, table=table,
+        index=index, store=store, bin_queries=bin_queries)
+    annotateFile(vcf + tmpextin, vcf + tmpextout, [annotator],
+        logfile=vcf + '.count.log', sep=sep, cache=cache, lookahead=lookahead)
     conn.close()
-    fh.close()
-    fh_out.close()
 
-### EOF
\ No newline at end of file
+### EOF
@@ -4,6 +4,7 @@ import subprocess
 import json
 import os
 import time
+import hashlib
 from botocore.exceptions import ClientError
 from configparser import SafeConfigParser # Python ConfigParser   https://docs.python.org/3/library/configparser.html
 
@@ -16,8 +17,39 @@ AWS_ACCESS_KEY_ID = config['aws']['access_key_id']
 AWS_SECRET_ACCESS_KEY = config['aws']['secret_access_key']
 REGION = config['aws']['region']
 SQS_QUEUE_URL = config['sqs']['queue_url']
+# Run jobs in this process so pooled database connections stay warm
+IN_PROCESS = config.getboolean('annotator', 'in_process', fallback=False)
+# Complete jobs whose input was annotated before from the earlier results
+REUSE_RESULTS = config.getboolean('annotator', 'reuse_results', fallback=False)
+# Annotate inputs as they download instead of after; results are only
+# reused with the hash of a whole input, so not together with reuse_results
+STREAM_INPUT = config.getboolean('annotator', 'stream_input', fallback=False)
+# Jobs replay what stages added for variants of earlier jobs from this cache
+ANNOTATION_CACHE = config.get('annotator', 'annotation_cache', fallback=None)
+# A job whose message was received this many times without completing is
+# marked failed and its message deleted; 0 leaves it to the redrive policy
+# of the queue
+MAX_RECEIVE_COUNT = config.getint('annotator', 'max_receive_count', fallback=5)
 
-def process_message(message):
+"""File object that hashes what is written to it
+   It has no seek, so boto3 writes a download to it in order.
+"""
+class HashingWriter(object):
+    def __init__(self, fh):
+        self.fh = fh
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.fh.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+"""Returns True when the SQS message can be deleted now; otherwise the job
+   deletes it once it is complete (see run.run_job)
+"""
+def process_message(message, receipt_handle=None):
     # Extract job parameters from the message body
     job_id = message['job_id']
     input_file_name = message['input_file_name']
@@ -26,19 +58,99 @@ def process_message(message):
     email = message['email']
     user_id = message['user_id']
 
+    # Stages of the user's tier, or the ones the job asked for; a job that
+    # asks for unknown stages, or none its tier has, can never run
+    stages = None
+    if message.get('role') or message.get('stages'):
+        import run
+        try:
+            stages = run.job_stages(message.get('role'), message.get('stages'))
+        except ValueError as e:
+            fail_job(message, str(e))
+            return True
+
     # Get the input file S3 object and copy it to a local file
     s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
     local_dir = f'/home/ec2-user/mpcs-cc/anntools/data/{job_id}'
     os.makedirs(local_dir, exist_ok=True)
     local_file_path = f'{local_dir}/{input_file_name}'
-    s3.download_file(bucket_name, s3_key, local_file_path)
+    input_s3 = None
+    if STREAM_INPUT and not REUSE_RESULTS:
+        # The job reads the input from S3 itself
+        input_s3 = (bucket_name, s3_key)
+        args = []
+    else:
+        # The message is kept invisible while the input downloads; the job
+        # keeps it so from then on
+        heartbeat = None
+        if receipt_handle:
+            import run
+            heartbeat = run.VisibilityHeartbeat(receipt_handle)
+            heartbeat.start()
+        try:
+            if not REUSE_RESULTS:
+                s3.download_file(bucket_name, s3_key, local_file_path)
+                args = []
+            else:
+                # The input is hashed as it is downloaded
+                fh = open(local_file_path, 'wb')
+                writer = HashingWriter(fh)
+                s3.download_fileobj(bucket_name, s3_key, writer)
+                fh.close()
+
+                import run
+                content_hash = writer.hexdigest()
+                version = run.result_version(stages)
+                try:
+                    if version is not None and run.reuse_result(content_hash, version, input_file_name, job_id, email, user_id):
+                        os.remove(local_file_path)
+                        return True
+                except Exception as e:
+                    print(f"Error reusing results for job {job_id}: {str(e)}")
+                args = [content_hash, version or '']
+        finally:
+            if heartbeat is not None:
+                heartbeat.stop()
+
+    # The annotation cache is kept for the reference version this worker
+    # looked up last, rather than one looked up for every job
+    reference_version = None
+    if ANNOTATION_CACHE:
+        import run
+        reference_version = run.current_reference_version()
+
+    # Run the job here, reusing this worker's connection pool
+    if IN_PROCESS:
+        import run
+        try:
+            run.run_job(local_file_path, job_id, email, user_id, *args,
+                receipt_handle=receipt_handle, stages=stages,
+                input_s3=input_s3, reference_version=reference_version)
+        except Exception as e:
+            print(f"Error running annotation for job {job_id}: {str(e)}")
+        return False
 
     # Launch the annotation process
     try:
-        subprocess.Popen(['python', 'run.py', local_file_path, job_id, email, user_id])
+        args = (args or ['', '']) + [receipt_handle or '',
+            ','.join(stages or [])]
+        if input_s3 is not None:
+            args.append(f"s3://{input_s3[0]}/{input_s3[1]}")
+        else:
+            args.append('')
+        args.append(reference_version or '')
+        subprocess.Popen(['python', 'run.py', local_file_path, job_id, email, user_id] + args)
         print(f"Annotation process launched for job {job_id}")
     except Exception as e:
         print(f"Error launching annotation process for job {job_id}: {str(e)}")
+    return False
+
+"""Marks the job of message failed; its message can be deleted then
+"""
+def fail_job(message, reason):
+    import run
+    print(f"Job {message['job_id']} failed: {reason}")
+    run.update_job_status(message['job_id'], 'FAILED', None, None, None)
 
 if __name__ == '__main__':
     # Connect to SQS and get the message queue
@@ -65,19 +177,31 @@ if __name__ == '__main__':
                     # Extract the job details from the message body
                     job_details = json.loads(message_body['Message'])
 
-                    # Process the message
-                    process_message(job_details)
+                    # A job that keeps failing is given up on, instead of
+                    # being delivered again for ever
+                    receive_count = int(message.get('Attributes', {}).get(
+                        'ApproximateReceiveCount', 1))
+                    if MAX_RECEIVE_COUNT and (receive_count > MAX_RECEIVE_COUNT):
+                        fail_job(job_details, f"received {receive_count} times")
+                        done = True
+                    else:
+                        # Process the message; a job that runs deletes its
+                        # message itself once it is complete
+                        done = process_message(job_details, message['ReceiptHandle'])
 
-                    # Delete the message from the queue
-                    sqs.delete_message(
-                        QueueUrl=SQS_QUEUE_URL,
-                        ReceiptHandle=message['ReceiptHandle']
-                    )
-                    print("Message deleted from the queue")
+                    if done:
+                        sqs.delete_message(
+                            QueueUrl=SQS_QUEUE_URL,
+                            ReceiptHandle=message['ReceiptHandle']
+                        )
+                        print("Message deleted from the queue")
             else:
                 print("No messages in the queue. Polling again...")
         except ClientError as e:
             print(f'Error: {e.response["Error"]["Message"]}')
+        except Exception as e:
+            # The message shows up again after its visibility timeout
+            print(f"Error processing message: {str(e)}")
 
         # Wait for a short interval before polling again
         time.sleep(1)
\ No newline at end of file
@@ -0,0 +1,238 @@
+# annotcache.py
+#
+# Persistent cache of what each stage adds to a record, shared across jobs
+#
+# Entries are keyed on the stage, the variant (CHROM, POS, REF, ALT) and the
+# context of the record the stage depends on (see RecordAnnotator in
+# annotate.py), and hold the text the stage added to INFO, the ID it wrote
+# and what it added to its counts. The cache is a SQLite file on the
+# instance. It keeps at most max_entries, evicting the least recently used,
+# and is emptied when the version of the reference data changes.
+#
+# The version of a table of the reference database is the one its loader
+# set in VERSION_TABLE; stages that read a table without one are not
+# cached. Loaders call setTableVersion after they load a table, or run:
+#
+#   python annotcache.py <table ...> [--version <version>]
+#   python annotcache.py --all [--version <version>]
+#
+# which sets the version of the tables, by default to the current time.
+#
+##
+
+import os
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+
+import refstore
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+# Bumped when stages change what they add for the same reference data
+CACHE_FORMAT = 2
+
+# Table the loaders of the reference database set the version of every
+# table they load in
+VERSION_TABLE = 'reference_version'
+VERSION_SCHEMA = f'create table if not exists {VERSION_TABLE} (' + \
+    'table_name varchar(64) not null primary key, ' + \
+    'version varchar(64) not null, ' + \
+    'updated timestamp not null default current_timestamp ' + \
+    'on update current_timestamp);'
+
+# Puts and touches are written in transactions of this many
+WRITE_BATCH = 1000
+
+
+"""Version of the reference data in store, or in the reference database
+   cursor is connected to; None when a table of the database has no
+   version, so that nothing is cached against it
+"""
+def referenceVersion(cursor=None, store=None):
+    versions = tableVersions(cursor, store=store)
+    if store is None:
+        missing = [t for t in sorted(refstore.TABLES.keys()) if t not in versions]
+        if (len(missing) > 0):
+            print(f"Reference tables without a version in {VERSION_TABLE}: " + \
+                ', '.join(missing))
+            return None
+
+    h = hashlib.sha1(str(CACHE_FORMAT).encode('utf-8'))
+    for table in sorted(versions):
+        h.update((table + '\t' + versions[table] + '\n').encode('utf-8'))
+    return h.hexdigest()
+
+
+"""Version of every table in store, or in the reference database cursor is
+   connected to, by table name
+   In the database, the version of a table is the one its loader set in
+   VERSION_TABLE (see setTableVersion); tables without one are left out.
+   The times in information_schema are not used: MySQL 8 caches them and
+   InnoDB does not keep update_time across restarts.
+"""
+def tableVersions(cursor=None, store=None):
+    versions = {}
+    if store is not None:
+        for table in sorted(os.listdir(store.root)):
+            path = os.path.join(store.root, table, 'meta.json')
+            if os.path.exists(path):
+                fh = open(path, 'rb')
+                h = hashlib.sha1(fh.read())
+                fh.close()
+                h.update(str(os.stat(path).st_mtime_ns).encode('utf-8'))
+                versions[table] = h.hexdigest()
+    else:
+        cursor.execute(f"show tables like '{VERSION_TABLE}';")
+        if (len(cursor.fetchall()) > 0):
+            cursor.execute(f'select table_name, version from {VERSION_TABLE};')
+            for row in cursor.fetchall():
+                versions[str(row[0])] = str(row[1])
+    return versions
+
+
+"""Version of the reference data annotator reads, from tableVersions; None
+   when a table it reads has no version
+"""
+def stageVersion(annotator, versions):
+    h = hashlib.sha1(str(CACHE_FORMAT).encode('utf-8'))
+    for table in annotator.tables():
+        if table not in versions:
+            return None
+        h.update((table + '\t' + versions[table] + '\n').encode('utf-8'))
+    return h.hexdigest()
+
+
+"""Sets the version of table in the reference database; loaders call it
+   once a table is loaded. The version defaults to the current UTC time.
+"""
+def setTableVersion(cursor, table, version=None):
+    if version is None:
+        version = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    cursor.execute(VERSION_SCHEMA)
+    cursor.execute(f'insert into {VERSION_TABLE} (table_name, version) ' + \
+        'values (%s, %s) on duplicate key update version = values(version);',
+        [table, version])
+    return version
+
+
+class AnnotationCache(object):
+    # Hits are written to the .count.log
+    reportHits = True
+
+    def __init__(self, path, version, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.version = version
+        self.max_entries = int(max_entries)
+        self.puts = []
+        self.touches = []
+
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('pragma journal_mode=wal;')
+        self.conn.execute('create table if not exists meta ' + \
+            '(name text primary key, value text);')
+        self.conn.execute('create table if not exists entries ' + \
+            '(stage text, variant text, context text, value text, ' + \
+            'used real, primary key (stage, variant, context));')
+        self.conn.execute('create index if not exists entries_used ' + \
+            'on entries (used);')
+        self.checkVersion()
+
+    """Empties the cache if it was filled for another version
+    """
+    def checkVersion(self):
+        self.conn.execute('begin immediate;')
+        row = self.conn.execute(
+            "select value from meta where name = 'version';").fetchone()
+        if (row is None) or (row[0] != self.version):
+            self.conn.execute('delete from entries;')
+            self.conn.execute('insert or replace into meta values ' + \
+                "('version', ?);", [self.version])
+        self.conn.execute('commit;')
+
+    def get(self, stage, variant, context):
+        row = self.conn.execute('select value from entries where stage = ? ' + \
+            'and variant = ? and context = ?;',
+            [stage, variant, context]).fetchone()
+        if row is None:
+            return None
+        self.touches.append((time.time(), stage, variant, context))
+        if (len(self.touches) >= WRITE_BATCH):
+            self.flush()
+        return json.loads(row[0])
+
+    """Variants of the list with an entry of stage, in any context
+    """
+    def known(self, stage, variants):
+        found = set()
+        variants = list(set(variants))
+        for i in range(0, len(variants), 500):
+            chunk = variants[i:i + 500]
+            rows = self.conn.execute('select distinct variant from entries ' + \
+                'where stage = ? and variant in (' + \
+                ','.join(['?'] * len(chunk)) + ');', [stage] + chunk)
+            found.update([r[0] for r in rows])
+        return found
+
+    def put(self, stage, variant, context, value):
+        self.puts.append((stage, variant, context, json.dumps(value),
+            time.time()))
+        if (len(self.puts) >= WRITE_BATCH):
+            self.flush()
+
+    """Writes pending puts and touches, then evicts entries past max_entries
+    """
+    def flush(self):
+        if (len(self.puts) == 0) and (len(self.touches) == 0):
+            return
+        self.conn.execute('begin immediate;')
+        self.conn.executemany('insert or replace into entries values ' + \
+            '(?, ?, ?, ?, ?);', self.puts)
+        self.conn.executemany('update entries set used = ? where stage = ? ' + \
+            'and variant = ? and context = ?;', self.touches)
+        count = self.conn.execute('select count(*) from entries;').fetchone()[0]
+        if (count > self.max_entries):
+            self.conn.execute('delete from entries where rowid in (select ' + \
+                'rowid from entries order by used limit ?);',
+                [count - self.max_entries])
+        self.conn.execute('commit;')
+        self.puts = []
+        self.touches = []
+
+    # Called before and after the stages of every record
+    def startRecord(self, fields):
+        pass
+
+    def recordDone(self):
+        pass
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    import utils as u
+
+    args = sys.argv[1:]
+    version = None
+    if (len(args) > 2) and (args[-2] == '--version'):
+        version = args[-1]
+        args = args[:-2]
+
+    if len(args) > 0:
+        tables = sorted(refstore.TABLES.keys()) if (args == ['--all']) else args
+
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        for table in tables:
+            print(f"{table} - {setTableVersion(cursor, table, version)}")
+        conn.commit()
+        conn.close()
+
+    else:
+        print("Please provide the tables to set the version of, or --all.")
+
+### EOF
@@ -0,0 +1,176 @@
+# bgzf.py
+#
+# BGZF (blocked gzip) writer for annotated output
+#
+# A BGZF file is a series of gzip members of at most 64 kB each, with the
+# size of the member in a 'BC' extra field, ended by an empty member. Any
+# gzip reader reads it as one stream; a reader that knows the blocks can
+# seek to a virtual offset, the file offset of a block shifted left 16
+# bits plus an offset into its uncompressed data (see tell). This is the
+# format bgzip and tabix use; compressed output is indexed as it is
+# written (see tabix.py).
+#
+##
+
+import gzip
+import zlib
+import struct
+
+# Uncompressed bytes per block, as in htslib, so that a block of data that
+# does not compress still fits in 64 kB
+BLOCK_SIZE = 0xff00
+
+# The empty block every BGZF file ends with
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff060042430200' + \
+    '1b0003000000000000000000')
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Header of a block up to its extra subfields, and its trailer
+BLOCK_HEADER_SIZE = 12
+BLOCK_TRAILER_SIZE = 8
+
+
+"""Compresses data into one BGZF block
+"""
+def compressBlock(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6,
+        66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+        len(data))
+
+
+"""Size of the BGZF block at pos in data, from its BC extra subfield
+"""
+def blockSize(data, pos):
+    if (data[pos:pos + 2] != GZIP_MAGIC):
+        raise IOError(f"No BGZF block at offset {pos}")
+    xlen = struct.unpack_from('<H', data, pos + 10)[0]
+    x = pos + BLOCK_HEADER_SIZE
+    while (x < pos + BLOCK_HEADER_SIZE + xlen):
+        si1, si2, slen = struct.unpack_from('<BBH', data, x)
+        if (si1 == 66) and (si2 == 67):
+            return struct.unpack_from('<H', data, x + 4)[0] + 1
+        x = x + 4 + slen
+    raise IOError(f"Block at offset {pos} is not BGZF")
+
+
+"""Blocks of data, BGZF read from file offset offset: the file offset and
+   the uncompressed data of every complete block
+"""
+def readBlocks(data, offset=0):
+    pos = 0
+    while (pos + BLOCK_HEADER_SIZE <= len(data)):
+        size = blockSize(data, pos)
+        if (pos + size > len(data)):
+            break
+        xlen = struct.unpack_from('<H', data, pos + 10)[0]
+        cdata = data[pos + BLOCK_HEADER_SIZE + xlen:pos + size - \
+            BLOCK_TRAILER_SIZE]
+        yield offset + pos, zlib.decompress(cdata, -15)
+        pos = pos + size
+
+
+"""Text file written as BGZF
+   tell gives the virtual offset the next write starts at. With an index
+   (see tabix.py), every line is added to it with the virtual offsets it
+   starts and ends at, and the index is saved to path.tbi on close.
+"""
+class BgzfWriter(object):
+    def __init__(self, path, level=6, index=None):
+        self.path = path
+        self.fh = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        # File offset of the block being filled
+        self.offset = 0
+        self.index = index
+        # Text of a line not ended yet
+        self.partial = ''
+
+    def write(self, text):
+        if self.index is None:
+            self.writeBytes(text.encode('utf-8'))
+            return
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            start = self.tell()
+            self.writeBytes((line + '\n').encode('utf-8'))
+            self.index.add(line, start, self.tell())
+
+    def writeBytes(self, data):
+        self.buffer.extend(data)
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.flushBlock(BLOCK_SIZE)
+
+    def flushBlock(self, size):
+        block = compressBlock(bytes(self.buffer[:size]), self.level)
+        self.fh.write(block)
+        self.offset = self.offset + len(block)
+        del self.buffer[:size]
+
+    def tell(self):
+        return (self.offset << 16) | len(self.buffer)
+
+    """Ends the current block, so the next write starts a new one
+    """
+    def flush(self):
+        if (len(self.buffer) > 0):
+            self.flushBlock(len(self.buffer))
+        self.fh.flush()
+
+    def close(self):
+        if (len(self.partial) > 0):
+            start = self.tell()
+            self.writeBytes(self.partial.encode('utf-8'))
+            self.index.add(self.partial, start, self.tell())
+            self.partial = ''
+        self.flush()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+        if self.index is not None:
+            self.index.save(self.path + '.tbi')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def isGzip(path):
+    fh = open(path, 'rb')
+    magic = fh.read(2)
+    fh.close()
+    return magic == GZIP_MAGIC
+
+
+"""Opens a text file: gzip and BGZF files are read transparently, and with
+   compress the file is written as BGZF and indexed
+"""
+def openText(path, mode='r', compress=False):
+    if ('r' in mode):
+        if isGzip(path):
+            return gzip.open(path, 'rt')
+        return open(path, mode)
+    if compress:
+        # tabix reads the blocks it indexes through this module
+        import tabix
+        return BgzfWriter(path, index=tabix.TabixIndex())
+    return open(path, mode)
+
+
+"""Compresses the text file src into the indexed BGZF file dst, streaming
+"""
+def compressFile(src, dst):
+    fh = open(src)
+    out = openText(dst, 'w', compress=True)
+    for line in fh:
+        out.write(line)
+    fh.close()
+    out.close()
+
+### EOF
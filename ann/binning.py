@@ -0,0 +1,147 @@
+# binning.py
+#
+# UCSC hierarchical binning scheme for range queries on the reference tables
+#
+# Tables from the UCSC Genome Browser carry a bin column: the smallest bin of
+# the scheme that holds the row's [chromStart, chromEnd). Adding "bin in (...)"
+# with the bins that can hold rows over a window lets MySQL read the rows from
+# a (chrom, bin) index instead of scanning a range of chromStart. Check the
+# reference database for those indexes with:
+#
+#   python binning.py [table ...]
+#
+##
+
+"""Bins of the standard scheme: 5 levels of 128 kb, 1 Mb, 8 Mb, 64 Mb and
+   512 Mb bins, each 8 times the size of the one before, smallest first
+"""
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+BIN_MAX_END = 512 * 1024 * 1024
+
+"""Bins of the tabix scheme: 16 kb up to 512 Mb bins, smallest first
+"""
+TABIX_BIN_OFFSETS = [4096 + 512 + 64 + 8 + 1] + BIN_OFFSETS
+TABIX_FIRST_SHIFT = 14
+
+"""Tables queried by range, with the name of their chrom column
+"""
+BIN_TABLES = [
+    ('refGene', 'chrom'),
+    ('cpgIslandExt', 'chrom'),
+    ('gwasCatalog', 'chrom'),
+    ('cytoBand', 'chrom'),
+    ('targetScanS', 'chrom'),
+    ('hugo', 'chrom'),
+    ('gadAll', 'chromosome'),
+    ('genomicSuperDups', 'chrom'),
+    ('dgv_Cnv', 'chrom'),
+    ('abParts_IG_T_CelReceptors', 'chrom'),
+    ('mcCarroll_Cnv', 'chrom'),
+    ('conrad_Cnv', 'chrom'),
+]
+
+# Whether a table has a bin column, by table name
+_binTables = {}
+
+
+"""Bin of the 0-based, half-open range [start, end)
+"""
+def binFromRange(start, end, offsets=BIN_OFFSETS, firstShift=BIN_FIRST_SHIFT):
+    startBin = start >> firstShift
+    endBin = (end - 1) >> firstShift
+    for offset in offsets:
+        if (startBin == endBin):
+            return offset + startBin
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    raise ValueError(f"[{start}, {end}) is out of range for the bin scheme")
+
+
+"""Bins of all ranges that can overlap [start, end), at most a few per level
+"""
+def overlappingBins(start, end, offsets=BIN_OFFSETS,
+    firstShift=BIN_FIRST_SHIFT):
+    bins = []
+    startBin = start >> firstShift
+    endBin = (end - 1) >> firstShift
+    for offset in offsets:
+        bins.extend(range(offset + startBin, offset + endBin + 1))
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    return bins
+
+
+"""Condition on bin for rows with chromStart <= hi and lo <= chromEnd
+   The rows are compared as closed intervals, so the window is widened
+   by one base. Returns '' past the end of the scheme.
+"""
+def binClause(lo, hi):
+    start = max(int(lo) - 1, 0)
+    end = int(hi) + 1
+    if (end > BIN_MAX_END):
+        return ''
+    return 'bin in (' + ','.join([str(b) for b in overlappingBins(start, end)]) + \
+        ') AND '
+
+
+"""Whether table has a bin column; checked once per process
+"""
+def hasBin(cursor, table):
+    if table not in _binTables:
+        cursor.execute('select * from ' + table + ' limit 0;')
+        cursor.fetchall()
+        names = [str(d[0]).lower() for d in cursor.description]
+        _binTables[table] = 'bin' in names
+    return _binTables[table]
+
+
+"""Returns a list of (table, problem) for tables with a bin column but no
+   index that starts with (chrom, bin)
+"""
+def checkIndexes(cursor, tables=BIN_TABLES):
+    problems = []
+    for (table, chromName) in tables:
+        if not hasBin(cursor, table):
+            print(f"{table}: no bin column")
+            continue
+
+        cursor.execute('show index from ' + table + ';')
+        names = [str(d[0]) for d in cursor.description]
+        keyIdx = names.index('Key_name')
+        seqIdx = names.index('Seq_in_index')
+        colIdx = names.index('Column_name')
+
+        keys = {}
+        for row in cursor.fetchall():
+            keys.setdefault(row[keyIdx], []).append(
+                (int(row[seqIdx]), str(row[colIdx]).lower()))
+
+        wanted = [chromName.lower(), 'bin']
+        found = [k for k in keys if [c for (s, c) in sorted(keys[k])][0:2] == wanted]
+        if (len(found) > 0):
+            print(f"{table}: ({chromName}, bin) index {found[0]}")
+        else:
+            print(f"{table}: missing ({chromName}, bin) index")
+            problems.append((table, f"missing ({chromName}, bin) index"))
+    return problems
+
+
+if __name__ == '__main__':
+    import sys
+    import utils as u
+
+    tables = BIN_TABLES
+    if len(sys.argv) > 1:
+        chroms = dict(BIN_TABLES)
+        tables = [(t, chroms.get(t, 'chrom')) for t in sys.argv[1:]]
+
+    conn = u.db_connect()
+    problems = checkIndexes(conn.cursor(), tables=tables)
+    conn.close()
+
+    if (len(problems) > 0):
+        sys.exit(1)
+
+### EOF
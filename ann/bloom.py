@@ -0,0 +1,138 @@
+# bloom.py
+#
+# Bloom filter of the dbSNP table for the dbSNP stage
+#
+# Keys are (CHR, POS, REF, INFO), upper-cased the way MySQL compares them.
+# The filter never says no for a key that is in the table, so a record is
+# only looked up in the database when the filter says it may be there. Build
+# the filter from the reference database with:
+#
+#   python bloom.py <file> [false positive rate]
+#
+##
+
+import sys
+import math
+import hashlib
+
+import numpy as np
+
+DEFAULT_FP_RATE = 0.01
+
+# Filters loaded by this process, by file name
+_filters = {}
+
+
+"""Key of a dbSNP row or of a record looked up in dbSNP
+"""
+def dbSnpKey(chrom, pos, ref, varclass):
+    return (str(chrom).upper() + '\t' + str(int(pos)) + '\t' + \
+        str(ref).upper() + '\t' + str(varclass).upper()).encode('utf-8')
+
+
+"""Bit positions of key, by double hashing one 128-bit digest
+"""
+def bitPositions(key, k, m):
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1 = int.from_bytes(digest[0:8], 'little')
+    h2 = int.from_bytes(digest[8:16], 'little') | 1
+    return [(h1 + i * h2) % m for i in range(0, k)]
+
+
+class BloomFilter(object):
+    def __init__(self, bits, k, count):
+        self.bits = bits
+        self.k = int(k)
+        self.m = len(bits) * 8
+        self.count = int(count)
+
+    """Empty filter for n keys at false positive rate fp
+    """
+    @classmethod
+    def forSize(cls, n, fp=DEFAULT_FP_RATE):
+        n = max(int(n), 1)
+        m = int(math.ceil(-n * math.log(fp) / (math.log(2) ** 2)))
+        k = max(int(round(m / float(n) * math.log(2))), 1)
+        return cls(np.zeros((m + 7) // 8, dtype=np.uint8), k, 0)
+
+    def addAll(self, keys):
+        positions = []
+        for key in keys:
+            positions.extend(bitPositions(key, self.k, self.m))
+            self.count = self.count + 1
+        positions = np.array(positions, dtype=np.int64)
+        np.bitwise_or.at(self.bits, positions >> 3,
+            (1 << (positions & 7)).astype(np.uint8))
+
+    def mayContain(self, key):
+        bits = self.bits
+        for p in bitPositions(key, self.k, self.m):
+            if not (bits[p >> 3] >> (p & 7)) & 1:
+                return False
+        return True
+
+    def sizeBytes(self):
+        return len(self.bits)
+
+    """False positive rate expected from the bits that are set
+    """
+    def fpRate(self):
+        setBits = int(np.unpackbits(self.bits).sum())
+        return (setBits / float(self.m)) ** self.k
+
+    def save(self, path):
+        fh = open(path, 'wb')
+        np.savez(fh, bits=self.bits, params=np.array([self.k, self.count],
+            dtype=np.int64))
+        fh.close()
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        k, count = data['params'].tolist()
+        return cls(data['bits'], k, count)
+
+
+"""Filter in path, loaded once per process
+"""
+def getFilter(path):
+    if path not in _filters:
+        _filters[path] = BloomFilter.load(path)
+    return _filters[path]
+
+
+"""Builds the filter from the dbSNP table, one chromosome at a time
+"""
+def buildDbSnpFilter(cursor, fp=DEFAULT_FP_RATE):
+    cursor.execute('select count(*) from dbSNP;')
+    bf = BloomFilter.forSize(int(cursor.fetchone()[0]), fp=fp)
+
+    cursor.execute('select distinct CHR from dbSNP;')
+    for chrom in sorted([str(r[0]) for r in cursor.fetchall()]):
+        cursor.execute('select CHR, POS, REF, INFO from dbSNP where CHR=%s;',
+            [chrom])
+        bf.addAll([dbSnpKey(r[0], r[1], r[2], r[3])
+            for r in cursor.fetchall()])
+        print(f"dbSNP {chrom} - done.")
+    return bf
+
+
+if __name__ == '__main__':
+    import utils as u
+
+    if len(sys.argv) > 1:
+        fp = DEFAULT_FP_RATE
+        if len(sys.argv) > 2:
+            fp = float(sys.argv[2])
+
+        conn = u.db_connect()
+        bf = buildDbSnpFilter(conn.cursor(), fp=fp)
+        conn.close()
+        bf.save(sys.argv[1])
+        print(f"{bf.count} keys, {bf.sizeBytes() // 1024} kB, " + \
+            f"{bf.k} hashes, ~{bf.fpRate() * 100:.2f}% false positives")
+
+    else:
+        print("Please provide the file to write the dbSNP filter to.")
+
+### EOF
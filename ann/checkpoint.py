@@ -0,0 +1,129 @@
+# checkpoint.py
+#
+# Per-stage checkpoints of a multi-pass annotation run
+#
+# The manifest lists the stages that finished, in order, with the output each
+# wrote and the size of the .count.log after it, if there was one yet. It is
+# replaced atomically after every stage, so a run that dies leaves the
+# manifest of the last stage that finished. S3Checkpoint also keeps the
+# manifest, the last output and the log in S3, so the next worker that gets
+# the job can go on from there.
+#
+##
+
+import os
+import json
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+class Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+        self.stages = []
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            fh = open(self.path)
+            self.stages = json.load(fh)['stages']
+            fh.close()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        fh = open(tmp, 'w')
+        json.dump({'stages': self.stages}, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.replace(tmp, self.path)
+
+    def isDone(self, name):
+        return name in [s['name'] for s in self.stages]
+
+    """Records that stage name finished and wrote output
+    """
+    def record(self, name, output, logfile):
+        for path in [output, logfile]:
+            if os.path.exists(path):
+                fh = open(path, 'rb')
+                os.fsync(fh.fileno())
+                fh.close()
+        hasLog = os.path.exists(logfile)
+        logSize = os.path.getsize(logfile) if hasLog else 0
+        self.stages.append({'name': name, 'output': os.path.basename(output),
+            'log': os.path.basename(logfile), 'log_size': logSize,
+            'has_log': hasLog})
+        self.save()
+
+    """Puts output, the output of the last stage that finished, and the
+       log back the way they were when it finished
+    """
+    def restore(self, output, logfile):
+        if not os.path.exists(output):
+            raise IOError(f"Checkpoint output {output} is missing")
+        if os.path.exists(logfile):
+            fh = open(logfile, 'r+b')
+            fh.truncate(self.stages[-1]['log_size'])
+            fh.close()
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+"""Checkpoint kept in S3 under prefix as well
+   After every stage its output, the log and then the manifest are
+   uploaded; the output of the stage before is deleted.
+"""
+class S3Checkpoint(Checkpoint):
+    def __init__(self, path, bucket, prefix, s3=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3 or boto3.client('s3')
+        Checkpoint.__init__(self, path)
+
+    def key(self, name):
+        return self.prefix + name
+
+    def load(self):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket,
+                Key=self.key('manifest.json'))
+            self.stages = json.loads(response['Body'].read())['stages']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise e
+            Checkpoint.load(self)
+
+    def record(self, name, output, logfile):
+        Checkpoint.record(self, name, output, logfile)
+        self.s3.upload_file(output, self.bucket, self.key(os.path.basename(output)))
+        if os.path.exists(logfile):
+            self.s3.upload_file(logfile, self.bucket,
+                self.key(os.path.basename(logfile)))
+        self.s3.upload_file(self.path, self.bucket, self.key('manifest.json'))
+        if (len(self.stages) > 1):
+            self.s3.delete_object(Bucket=self.bucket,
+                Key=self.key(self.stages[-2]['output']))
+
+    def restore(self, output, logfile):
+        if not os.path.exists(output):
+            self.s3.download_file(self.bucket,
+                self.key(os.path.basename(output)), output)
+            # Stages that write no log (bigRefGene) leave none to download
+            if self.stages[-1].get('has_log', self.stages[-1]['log_size'] > 0):
+                self.s3.download_file(self.bucket,
+                    self.key(os.path.basename(logfile)), logfile)
+        Checkpoint.restore(self, output, logfile)
+
+    def clear(self):
+        Checkpoint.clear(self)
+        names = ['manifest.json']
+        if (len(self.stages) > 0):
+            names = names + [self.stages[-1]['output'], self.stages[-1]['log']]
+        for name in names:
+            self.s3.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+### EOF
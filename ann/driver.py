@@ -12,110 +12,713 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import shutil
+import functools
+import multiprocessing
+from array import array
 import file_utils as fu
+import utils as u
 import annotate as ann
+import intervals
+import refstore
+import bloom
+import annotcache
+import stagelog
+import pipeline
+import lookahead as la
+import bgzf
+import tabix
 
-def run(infile, format):
+"""Stage registry: every stage, in run order, with what it reads from a
+   record and what it writes to it. 'ID' is the ID column, the rest are
+   INFO keys. A stage depends on the stages before it that write what it
+   reads, so selecting it selects them as well.
+"""
+STAGE_REGISTRY = [
+    ('dbSNP', [], ['ID', 'DB', 'VC', 'GMAF']),
+    ('bigRefGene', [], ['name', 'name2', 'transcriptStrand', 'positionType',
+        'frame', 'mrnaCoord', 'codonCoord', 'spliceDist', 'referenceCodon',
+        'referenceAA', 'variantCodon', 'variantAA', 'changesAA',
+        'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+        'inCodingRegion', 'spliceInfo', 'uorfChange']),
+    ('refGene', ['positionType'], ['name', 'name2', 'transcriptStrand',
+        'exon', 'non_coding_exon', 'putativePromoterRegion', 'positionType']),
+    ('cytoBand', [], ['cytoBand']),
+    ('gadAll', [], ['gadAll']),
+    ('gwasCatalog', [], ['gwasCatalog']),
+    ('targetScanS', [], ['miRNAsites']),
+    ('hugo', [], ['HGNC_GeneAnnotation']),
+    ('dgv_Cnv', [], ['dgv_Cnv']),
+    ('abParts_IG_T_CelReceptors', [], ['abParts_IG_T_CelReceptors']),
+    ('mcCarroll_Cnv', [], ['mcCarroll_Cnv']),
+    ('conrad_Cnv', [], ['conrad_Cnv']),
+    ('genomicSuperDups', [], ['genomicSuperDups', 'otherChrom', 'otherStart',
+        'otherEnd']),
+    ('tfbsConsSites', [], ['tfbsRegion']),
+]
 
-    print("Running . . .")
+STAGE_NAMES = [s[0] for s in STAGE_REGISTRY]
+
+# Stages of a tier, by user role; roles not listed get every stage
+TIER_STAGES = {
+    'free_user': ['dbSNP', 'refGene', 'cytoBand', 'hugo'],
+}
+
+
+"""Names of the stages to run for the requested ones, plus the stages they
+   depend on, in run order; every stage when none are requested
+"""
+def resolveStages(requested=None):
+    if requested is None:
+        return list(STAGE_NAMES)
+    if (len(requested) == 0):
+        raise ValueError("No stages selected")
+    unknown = [name for name in requested if name not in STAGE_NAMES]
+    if (len(unknown) > 0):
+        raise ValueError(f"Unknown stages: {', '.join(unknown)}")
+
+    selected = set(requested)
+    for name, reads, writes in reversed(STAGE_REGISTRY):
+        if name not in selected:
+            continue
+        for before, r, w in STAGE_REGISTRY[:STAGE_NAMES.index(name)]:
+            if (len(set(reads) & set(w)) > 0):
+                selected.add(before)
+    return [name for name in STAGE_NAMES if name in selected]
+
+
+"""Annotators in the order the multi-pass run applies them, one per stage
+   of STAGE_REGISTRY; only those of stages, if given, are built
+"""
+def getAnnotators(cursor, format='vcf', indexes=None, store=None,
+    bin_queries=False, dbsnp_filter=None, stages=None):
+    indexes = indexes or {}
+
+    def cnv(table):
+        return lambda: ann.CnvAnnotator(cursor, format=format, table=table,
+            index=indexes.get(table), store=store, bin_queries=bin_queries)
+
+    factories = {
+        'dbSNP': lambda: ann.DbSnpAnnotator(cursor, format=format,
+            store=store, filter=dbsnp_filter, index=indexes.get('dbSNP')),
+        'bigRefGene': lambda: ann.BigRefGeneAnnotator(cursor, format=format,
+            store=store),
+        'refGene': lambda: ann.GeneAnnotator(cursor, format=format,
+            table='refGene', promoter_offset=500, store=store,
+            bin_queries=bin_queries),
+        'cytoBand': lambda: ann.CytobandAnnotator(cursor, format=format,
+            table='cytoBand', index=indexes.get('cytoBand'), store=store,
+            bin_queries=bin_queries),
+        'gadAll': lambda: ann.GadAllAnnotator(cursor, format=format,
+            table='gadAll', index=indexes.get('gadAll'), store=store,
+            bin_queries=bin_queries),
+        'gwasCatalog': lambda: ann.GwasCatalogAnnotator(cursor, format=format,
+            table='gwasCatalog', index=indexes.get('gwasCatalog'),
+            store=store, bin_queries=bin_queries),
+        'targetScanS': lambda: ann.MiRNAAnnotator(cursor, format=format,
+            table='targetScanS', index=indexes.get('targetScanS'),
+            store=store, bin_queries=bin_queries),
+        'hugo': lambda: ann.HugoAnnotator(cursor, format=format,
+            table='hugo', index=indexes.get('hugo'), store=store,
+            bin_queries=bin_queries),
+        'dgv_Cnv': cnv('dgv_Cnv'),
+        'abParts_IG_T_CelReceptors': cnv('abParts_IG_T_CelReceptors'),
+        'mcCarroll_Cnv': cnv('mcCarroll_Cnv'),
+        'conrad_Cnv': cnv('conrad_Cnv'),
+        'genomicSuperDups': lambda: ann.GenomicSuperDupsAnnotator(cursor,
+            format=format, table='genomicSuperDups',
+            index=indexes.get('genomicSuperDups'), store=store,
+            bin_queries=bin_queries),
+        'tfbsConsSites': lambda: ann.TfbsConsSitesAnnotator(cursor,
+            format=format, table='tfbsConsSites', store=store,
+            bin_queries=bin_queries),
+    }
+    return [factories[name]() for name in STAGE_NAMES
+        if (stages is None) or (name in stages)]
+
+
+"""Annotated output of infile, plain or compressed; x.vcf and x.vcf.gz
+   are both annotated into x.annot.vcf, or x.annot.vcf.gz
+"""
+def annotatedPath(infile, compress=False):
+    if infile.endswith('.gz'):
+        infile = infile[:-len('.gz')]
+    path = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if compress:
+        path = path + '.gz'
+    return path
+
+
+"""Moves the output at path to annotated, with its index if it has one
+"""
+def moveResult(path, annotated):
+    if os.path.exists(tabix.indexPath(path)):
+        os.replace(tabix.indexPath(path), tabix.indexPath(annotated))
+    os.replace(path, annotated)
+
+
+"""Version of the reference data of every annotator, by its stage name in
+   the annotation cache
+"""
+def stageVersions(annotators, cursor, store=None):
+    versions = annotcache.tableVersions(cursor, store=store)
+    return dict([(a.cacheName(), annotcache.stageVersion(a, versions))
+        for a in annotators])
+
+
+"""Single pass: every record is parsed once, goes through all annotators
+   in memory and the annotated file is written once. With stage_log what
+   every stage added is logged for reannotate (see stagelog.py).
+"""
+def runFused(infile, format, batch_size=None, indexes=None, store=None,
+    bin_queries=False, dbsnp_filter=None, cache=None, stage_log=False,
+    stages=None, lookahead=None, compress=False, source=None):
+    conn = ann.stageConnect(store)
+    annotators = getAnnotators(conn.cursor(), format=format, indexes=indexes,
+        store=store, bin_queries=bin_queries, dbsnp_filter=dbsnp_filter,
+        stages=stages)
+    if stage_log:
+        cache = stagelog.StageLog(stagelog.stageLogPath(infile),
+            stageVersions(annotators, conn.cursor(), store=store), cache=cache)
+    ann.annotateFile(infile, infile + '.annot', annotators,
+        logfile=infile + '.count.log', logmode='w', batch_size=batch_size,
+        cache=cache, lookahead=lookahead, compress=compress, source=source)
+    if stage_log:
+        cache.close()
+    conn.close()
+    print("All annotations - done.")
+
+
+"""Annotates the annotated output of infile again after reference tables
+   changed, from the stage log its fused run wrote (see stagelog.py). Stages
+   whose tables did not change replay what they added; the output, the
+   .count.log and the stage log are replaced. Returns False when no table
+   changed, and nothing was.
+"""
+def reannotate(infile, format, batch_size=None, store_path=None,
+    bin_queries=False, dbsnp_filter=None, point_index_dir=None):
+
+    print("Re-annotating . . .")
+
+    store = None
+    if store_path:
+        store = refstore.ReferenceStore(store_path)
+    indexes = {}
+    if point_index_dir and store is None:
+        indexes.update(intervals.loadPointIndexes(point_index_dir))
+    filter = None
+    if dbsnp_filter and store is None:
+        filter = bloom.getFilter(dbsnp_filter)
+
+    logpath = stagelog.stageLogPath(infile)
+    reader = stagelog.StageLogReader(logpath)
+
+    # Only the stages of the run that wrote the log
+    conn = ann.stageConnect(store)
+    annotators = [a for a in getAnnotators(conn.cursor(), format=format,
+        indexes=indexes, store=store, bin_queries=bin_queries,
+        dbsnp_filter=filter) if a.cacheName() in reader.versions]
+    versions = stageVersions(annotators, conn.cursor(), store=store)
+    changed = [a.cacheName() for a in annotators
+        if (versions[a.cacheName()] is None)
+        or (reader.versions.get(a.cacheName()) != versions[a.cacheName()])]
+    if (len(changed) == 0):
+        reader.close()
+        conn.close()
+        print("Reference data unchanged - nothing to re-annotate.")
+        return False
+    print(f"Changed: {', '.join(changed)}")
+
+    # The input records, rebuilt from the annotated file and the log
+    compress = os.path.exists(annotatedPath(infile, compress=True))
+    annotated = annotatedPath(infile, compress=compress)
+    fh = bgzf.openText(annotated)
+    fh_out = open(infile + '.reannot', 'w')
+    for line in fh:
+        line = line.strip()
+        if any([a.isRecord(line) for a in annotators]):
+            line = stagelog.originalLine(line, reader.next())
+        fh_out.write(line + '\n')
+    fh.close()
+    fh_out.close()
+    reader.close()
+
+    reader = stagelog.StageLogReader(logpath)
+    log = stagelog.StageLog(logpath, versions)
+    ann.annotateFile(infile + '.reannot', infile + '.annot', annotators,
+        logfile=infile + '.count.log', logmode='w', batch_size=batch_size,
+        cache=stagelog.StageReplay(reader, versions, log), compress=compress)
+    reader.close()
+    log.close()
+    conn.close()
+
+    moveResult(infile + '.annot', annotated)
+    fu.delete(infile + '.reannot')
+    for a in annotators:
+        if (a.cache_misses > 0):
+            print(f"{a.cacheName()}: {a.cache_misses} of " + \
+                f"{a.cache_hits + a.cache_misses} records annotated again")
+    print("Re-annotation - done.")
+    printPoolStats()
+    return True
+
+
+"""Splits infile into one file per chromosome in shard_dir
+   Header lines stay in memory. Returns the header lines, the shard files
+   largest first, and for every line of infile the number of its shard
+   (-1 for header lines), so the annotated shards can be merged back in
+   the original order. Given a source, its stream is split instead.
+"""
+def splitByChrom(infile, shard_dir, sep='\t', source=None):
+    header = []
+    layout = array('i')
+    shards = {}
+    handles = []
+    sizes = []
+
+    if source is not None:
+        fh = source.open()
+    else:
+        fh = bgzf.openText(infile)
+    for line in fh:
+        if line.startswith('#'):
+            header.append(line)
+            layout.append(-1)
+            continue
+        chrom = line.split(sep, 1)[0].strip()
+        if chrom not in shards:
+            shards[chrom] = len(handles)
+            handles.append(open(os.path.join(shard_dir,
+                str(len(handles)) + '.vcf'), 'w'))
+            sizes.append(0)
+        n = shards[chrom]
+        if not line.endswith('\n'):
+            line = line + '\n'
+        handles[n].write(line)
+        sizes[n] = sizes[n] + 1
+        layout.append(n)
+    fh.close()
+
+    for h in handles:
+        h.close()
+
+    files = [os.path.join(shard_dir, str(n) + '.vcf')
+        for n in range(0, len(handles))]
+    order = sorted(range(0, len(files)), key=lambda n: -sizes[n])
+    return header, [files[n] for n in order], layout
+
+
+# State of a parallel-mode worker process, set by initShardWorker
+_worker = {}
+
+def initShardWorker(format, batch_size, indexes, store_path, bin_queries,
+    filter_path, cache_args, stages):
+    u.resetPool()
+    _worker['format'] = format
+    _worker['stages'] = stages
+    _worker['batch_size'] = batch_size
+    _worker['indexes'] = indexes
+    _worker['bin_queries'] = bin_queries
+    _worker['store'] = None
+    if store_path:
+        _worker['store'] = refstore.ReferenceStore(store_path)
+    _worker['dbsnp_filter'] = None
+    if filter_path:
+        _worker['dbsnp_filter'] = bloom.getFilter(filter_path)
+    # Every worker opens the cache file itself
+    _worker['cache'] = None
+    if cache_args is not None:
+        _worker['cache'] = annotcache.AnnotationCache(*cache_args)
+
+
+"""Annotates one shard in a worker; returns the counts of every annotator
+"""
+def annotateShard(shard):
+    store = _worker['store']
+    conn = ann.stageConnect(store)
+    annotators = getAnnotators(conn.cursor(), format=_worker['format'],
+        indexes=_worker['indexes'], store=store,
+        bin_queries=_worker['bin_queries'],
+        dbsnp_filter=_worker['dbsnp_filter'], stages=_worker['stages'])
+    ann.annotateFile(shard, shard + '.annot', annotators,
+        batch_size=_worker['batch_size'], cache=_worker['cache'])
+    conn.close()
+    return [annotator.getCounts() for annotator in annotators]
+
+
+"""Parallel mode: records are split by chromosome and the shards are
+   annotated in single-pass mode by a pool of worker processes. The
+   shards are merged back in the original order and the counts of the
+   shards are added up into one .count.log.
+"""
+def runParallel(infile, format, workers, batch_size=None, indexes=None,
+    store_path=None, bin_queries=False, filter_path=None, cache_args=None,
+    stages=None, compress=False, source=None):
+
+    shard_dir = infile + '.shards'
+    os.makedirs(shard_dir, exist_ok=True)
+    header, shards, layout = splitByChrom(infile, shard_dir, source=source)
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    pool = multiprocessing.Pool(processes=workers, initializer=initShardWorker,
+        initargs=(format, batch_size, indexes, store_path, bin_queries,
+            filter_path, cache_args, stages))
+    shardCounts = pool.map(annotateShard, shards, chunksize=1)
+    pool.close()
+    pool.join()
+
+    # Shard files are numbered in input order, the list is by size
+    outputs = {}
+    for shard in shards:
+        n = int(os.path.basename(shard).split('.')[0])
+        outputs[n] = open(shard + '.annot')
+
+    fh_out = bgzf.openText(infile + '.annot', 'w', compress=compress)
+    h = 0
+    for n in layout:
+        if (n < 0):
+            fh_out.write(header[h].strip() + '\n')
+            h = h + 1
+        else:
+            fh_out.write(outputs[n].readline())
+    fh_out.close()
+
+    for fh in outputs.values():
+        fh.close()
+    shutil.rmtree(shard_dir)
+
+    dbsnp_filter = None
+    if filter_path:
+        dbsnp_filter = bloom.getFilter(filter_path)
+    annotators = getAnnotators(None, format=format, dbsnp_filter=dbsnp_filter,
+        stages=stages)
+    fh_log = open(infile + '.count.log', 'w')
+    for i in range(0, len(annotators)):
+        base = annotators[i].getCounts()
+        for counts in shardCounts:
+            annotators[i].addCounts(counts[i], base=base)
+        annotators[i].writeLog(fh_log)
+        annotators[i].writeCacheLog(fh_log)
+    fh_log.close()
+    print("All annotations - done.")
+
+
+"""Sets up a pipeline worker (see pipeline.py): its annotators, its cache
+   and the function that releases them
+"""
+def pipelineSetup(format, indexes, store, bin_queries, dbsnp_filter,
+    cache_args, stages):
+    conn = ann.stageConnect(store)
+    annotators = getAnnotators(conn.cursor(), format=format, indexes=indexes,
+        store=store, bin_queries=bin_queries, dbsnp_filter=dbsnp_filter,
+        stages=stages)
+    cache = None
+    if cache_args is not None:
+        cache = annotcache.AnnotationCache(*cache_args)
+
+    def release():
+        if cache is not None:
+            cache.close()
+        conn.close()
+    return annotators, cache, release
+
+
+"""Pipeline mode: a reader, a pool of workers and a writer stream the
+   records through all annotators (see pipeline.py); with processes the
+   workers are processes instead of threads. The counts of the workers are
+   added up into one .count.log.
+"""
+def runPipeline(infile, format, workers, processes=False, batch_size=None,
+    queue_depth=pipeline.DEFAULT_QUEUE_DEPTH, indexes=None, store=None,
+    bin_queries=False, dbsnp_filter=None, cache_args=None, stages=None,
+    compress=False, source=None):
+
+    # Thread workers hold a connection of the pool of this process for as
+    # long as they run; worker processes have pools of their own
+    if (not processes) and (store is None) and (workers > u.getPool().size):
+        print(f"Pipeline: {u.getPool().size} workers instead of {workers}, " + \
+            f"the connection pool has {u.getPool().size} (ANN_DB_POOL_SIZE)")
+        workers = u.getPool().size
+
+    setup = functools.partial(pipelineSetup, format, indexes, store,
+        bin_queries, dbsnp_filter, cache_args, stages)
+    workerCounts, stats = pipeline.run(infile, infile + '.annot', setup,
+        workers, processes=processes,
+        chunk_size=batch_size or pipeline.DEFAULT_CHUNK_SIZE,
+        depth=queue_depth, compress=compress, source=source)
+
+    annotators = getAnnotators(None, format=format, dbsnp_filter=dbsnp_filter,
+        stages=stages)
+    fh_log = open(infile + '.count.log', 'w')
+    for i in range(0, len(annotators)):
+        base = annotators[i].getCounts()
+        for counts, workerBase in workerCounts:
+            annotators[i].addCounts(counts[i], base=workerBase[i])
+        annotators[i].writeLog(fh_log)
+        annotators[i].writeCacheLog(fh_log)
+    fh_log.close()
+    pipeline.printStats(stats)
+    print("All annotations - done.")
+
+
+"""Stages of the multi-pass run, in order: (name, message, function)
+   The function of a stage annotates infile + tmpextin into
+   infile + tmpextout. Only the stages named in stages, if given.
+"""
+def getStages(infile, batch_size=None, indexes=None, store=None,
+    bin_queries=False, dbsnp_filter=None, cache=None, stages=None,
+    lookahead=None):
+    indexes = indexes or {}
+    allStages = [
+        ('dbSNP', "dbSNP", lambda tmpextin, tmpextout:
+            ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin=tmpextin,
+            tmpextout=tmpextout, batch_size=batch_size, store=store,
+            filter=dbsnp_filter, index=indexes.get('dbSNP'), cache=cache,
+            lookahead=lookahead)),
+        ('bigRefGene', "BigRefGene", lambda tmpextin, tmpextout:
+            ann.getBigRefGene(vcf=infile, format='vcf', tmpextin=tmpextin,
+            tmpextout=tmpextout, batch_size=batch_size, store=store,
+            cache=cache, lookahead=lookahead)),
+        ('refGene', "BigRefGene", lambda tmpextin, tmpextout:
+            ann.getGenes(vcf=infile, format='vcf', table='refGene',
+            promoter_offset=500, tmpextin=tmpextin, tmpextout=tmpextout,
+            store=store, bin_queries=bin_queries, cache=cache,
+            lookahead=lookahead)),
+        ('cytoBand', "Cytoband", lambda tmpextin, tmpextout:
+            ann.addOverlapWithCytoband(vcf=infile, format='vcf',
+            table='cytoBand', tmpextin=tmpextin, tmpextout=tmpextout,
+            index=indexes.get('cytoBand'), store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+        ('gadAll', "gadAll", lambda tmpextin, tmpextout:
+            ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll',
+            tmpextin=tmpextin, tmpextout=tmpextout,
+            index=indexes.get('gadAll'), store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+        ('gwasCatalog', "GwasCatalog", lambda tmpextin, tmpextout:
+            ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf',
+            table='gwasCatalog', tmpextin=tmpextin, tmpextout=tmpextout,
+            index=indexes.get('gwasCatalog'), store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+        ('targetScanS', "miRNA", lambda tmpextin, tmpextout:
+            ann.addOverlapWithMiRNA(vcf=infile, format='vcf',
+            table='targetScanS', tmpextin=tmpextin, tmpextout=tmpextout,
+            index=indexes.get('targetScanS'), store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+        ('hugo', "HUGO Gene Nomenclature Committee", lambda tmpextin, tmpextout:
+            ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf',
+            table='hugo', tmpextin=tmpextin, tmpextout=tmpextout,
+            index=indexes.get('hugo'), store=store, bin_queries=bin_queries,
+            cache=cache, lookahead=lookahead)),
+        ('dgv_Cnv', "dgv_Cnv", lambda tmpextin, tmpextout:
+            ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf',
+            table='dgv_Cnv', tmpextin=tmpextin, tmpextout=tmpextout,
+            index=indexes.get('dgv_Cnv'), store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+        ('abParts_IG_T_CelReceptors', "abParts_IG_T_CelReceptors",
+            lambda tmpextin, tmpextout:
+            ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf',
+            table='abParts_IG_T_CelReceptors', tmpextin=tmpextin,
+            tmpextout=tmpextout,
+            index=indexes.get('abParts_IG_T_CelReceptors'), store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+        ('mcCarroll_Cnv', "mcCarroll_Cnv", lambda tmpextin, tmpextout:
+            ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf',
+            table='mcCarroll_Cnv', tmpextin=tmpextin, tmpextout=tmpextout,
+            index=indexes.get('mcCarroll_Cnv'), store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+        ('conrad_Cnv', "conrad_Cnv", lambda tmpextin, tmpextout:
+            ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf',
+            table='conrad_Cnv', tmpextin=tmpextin, tmpextout=tmpextout,
+            index=indexes.get('conrad_Cnv'), store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+        ('genomicSuperDups', "genomicSuperDups", lambda tmpextin, tmpextout:
+            ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf',
+            table='genomicSuperDups', tmpextin=tmpextin, tmpextout=tmpextout,
+            index=indexes.get('genomicSuperDups'), store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+        ('tfbsConsSites', "addOverlapWithTfbsConsSites",
+            lambda tmpextin, tmpextout:
+            ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
+            tmpextin=tmpextin, tmpextout=tmpextout, store=store,
+            bin_queries=bin_queries, cache=cache, lookahead=lookahead)),
+    ]
+    if stages is None:
+        return allStages
+    return [s for s in allStages if s[0] in stages]
+
+
+"""Runs the stages one after the other; stage n writes infile.n and the
+   last output becomes infile.annot. With a Checkpoint (see checkpoint.py)
+   every finished stage is recorded, and stages a previous run finished
+   are skipped: the run goes on from the output of the last of them. With
+   compress the last output is compressed into infile.annot.
+"""
+def runStages(infile, stages, checkpoint=None, compress=False):
+    logfile = infile + '.count.log'
+    tmpextin = ''
+    restored = False
+    if (checkpoint is None) or not checkpoint.isDone(stages[0][0]):
+        # Stages append to the log; without dbSNP no stage starts it anew
+        fu.delete(logfile)
+    for n in range(1, len(stages) + 1):
+        name, message, stage = stages[n - 1]
+        tmpextout = '.' + str(n)
+        if (checkpoint is not None) and checkpoint.isDone(name):
+            print(f"{message} - done before.")
+            tmpextin = tmpextout
+            continue
+
+        if (checkpoint is not None) and (len(tmpextin) > 0) and not restored:
+            checkpoint.restore(infile + tmpextin, logfile)
+        restored = True
+
+        stage(tmpextin, tmpextout)
+        print(f"{message} - done.")
+        if checkpoint is not None:
+            checkpoint.record(name, infile + tmpextout, logfile)
+        tmpextin = tmpextout
+
+    if (checkpoint is not None) and (len(tmpextin) > 0) and not restored:
+        checkpoint.restore(infile + tmpextin, logfile)
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(1, len(stages)):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    if compress:
+        bgzf.compressFile(infile + tmpextin, infile + '.annot')
+        fu.delete(infile + tmpextin)
+    else:
+        os.rename(infile + tmpextin, infile + '.annot')
+
+
+"""Prints the reference database connection pool counters
+"""
+def printPoolStats():
+    stats = u.getPool().stats()
+    print(f"Connection pool: {stats['hits']} hits, {stats['misses']} misses, " + \
+        f"{stats['waits']} waits ({stats['wait_time']:.3f}s), " + \
+        f"{stats['idle']} idle")
+
+
+def run(infile, format, fused=False, batch_size=None, memory_budget_mb=0,
+    store_path=None, workers=0, bin_queries=False, dbsnp_filter=None,
+    point_index_dir=None, annotation_cache=None,
+    annotation_cache_size=annotcache.DEFAULT_MAX_ENTRIES, checkpoint=None,
+    stage_log=False, stages=None, pipeline_workers=0,
+    pipeline_processes=False, queue_depth=pipeline.DEFAULT_QUEUE_DEPTH,
+    lookahead=0, lookahead_connections=la.DEFAULT_CONNECTIONS,
+    compress_output=False, source=None, reference_version=None):
+
+    print("Running . . .")
+
+    # Stages read a local reference store instead of MySQL when one is given
+    store = None
+    if store_path:
+        store = refstore.ReferenceStore(store_path)
+
+    # Overlap tables that fit in the budget are answered in memory
+    indexes = {}
+    if memory_budget_mb and store is None:
+        conn = u.db_pool_connect()
+        indexes = intervals.loadIndexes(conn.cursor(), memory_budget_mb)
+        conn.close()
+
+    # Tables queried by exact position are answered from saved PointIndexes
+    if point_index_dir and store is None:
+        indexes.update(intervals.loadPointIndexes(point_index_dir))
+
+    # dbSNP lookups the filter rules out are skipped; the store needs none
+    filter = None
+    if dbsnp_filter and store is None:
+        filter = bloom.getFilter(dbsnp_filter)
+    else:
+        dbsnp_filter = None
+
+    # What stages added for variants of earlier jobs is replayed from the
+    # annotation cache, as long as the reference data did not change; its
+    # version is looked up unless the caller has it (reference_version)
+    cache_args = None
+    cache = None
+    if annotation_cache:
+        version = reference_version
+        if version is None:
+            conn = ann.stageConnect(store)
+            version = annotcache.referenceVersion(conn.cursor(), store=store)
+            conn.close()
+        if version is None:
+            print("Annotation cache - off, the reference data has no version.")
+        else:
+            cache_args = (annotation_cache, version, annotation_cache_size)
+
+    # Only the selected stages and the stages they depend on are run
+    if stages is not None:
+        stages = resolveStages(stages)
+        print(f"Stages: {', '.join(stages)}")
+
+    if stage_log and (workers > 1 or pipeline_workers > 0 or not fused):
+        print("Stage log - only written in fused mode.")
+
+    # A streamed input (see ingest.py) is annotated as it downloads, except
+    # in multi-pass mode: every pass reads a file, so it is read to infile
+    if (source is not None) and (workers <= 1) and (pipeline_workers == 0) \
+        and not fused:
+        source.drain(infile)
+        source.printStats()
+        source = None
+
+    if (workers > 1):
+        runParallel(infile, format, workers, batch_size=batch_size,
+            indexes=indexes, store_path=store_path, bin_queries=bin_queries,
+            filter_path=dbsnp_filter, cache_args=cache_args, stages=stages,
+            compress=compress_output, source=source)
+        moveResult(infile + '.annot', annotatedPath(infile, compress_output))
+        if source is not None:
+            source.printStats()
+        printPoolStats()
+        return
+
+    if (pipeline_workers > 0):
+        runPipeline(infile, format, pipeline_workers,
+            processes=pipeline_processes, batch_size=batch_size,
+            queue_depth=queue_depth, indexes=indexes, store=store,
+            bin_queries=bin_queries, dbsnp_filter=filter,
+            cache_args=cache_args, stages=stages, compress=compress_output,
+            source=source)
+        moveResult(infile + '.annot', annotatedPath(infile, compress_output))
+        if source is not None:
+            source.printStats()
+        printPoolStats()
+        return
+
+    if cache_args is not None:
+        cache = annotcache.AnnotationCache(*cache_args)
+
+    # Per-record lookups of the next lookahead records run concurrently
+    # while the current ones are annotated
+    ahead = None
+    if lookahead:
+        ahead = la.Lookahead(lookahead, lookahead_connections)
+
+    if fused:
+        runFused(infile, format, batch_size=batch_size, indexes=indexes,
+            store=store, bin_queries=bin_queries, dbsnp_filter=filter,
+            cache=cache, stage_log=stage_log, stages=stages, lookahead=ahead,
+            compress=compress_output, source=source)
+    else:
+        stages = getStages(infile, batch_size=batch_size, indexes=indexes,
+            store=store, bin_queries=bin_queries, dbsnp_filter=filter,
+            cache=cache, stages=stages, lookahead=ahead)
+        runStages(infile, stages, checkpoint=checkpoint,
+            compress=compress_output)
+
+    moveResult(infile + '.annot', annotatedPath(infile, compress_output))
+    if cache is not None:
+        cache.close()
+    if ahead is not None:
+        ahead.close()
+        ahead.printStats()
+    if source is not None:
+        source.printStats()
+    printPoolStats()
 
 ### EOF
\ No newline at end of file
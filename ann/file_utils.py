@@ -16,6 +16,7 @@ import csv
 import os
 import shutil
 import sys
+import gzip
 
 import itertools, operator
 
@@ -218,6 +219,16 @@ def readindices(filename, sep='\t'):
     return sorted(values)
 
 
+"""Reads an open file in lists of up to n lines
+"""
+def readBatches(fh, n):
+    while True:
+        batch = list(itertools.islice(fh, n))
+        if (len(batch) == 0):
+            return
+        yield batch
+
+
 """"Count number of lines in file, file is not loaded to memory
 """
 def linecount(filename):
@@ -228,15 +239,18 @@ def linecount(filename):
     return linenum
 
 
-"""Saves list of rows and columns in a text file
+"""Saves list of rows and columns in a text file; with compress, in
+   txtfile.gz
 """
 def save2txt(read_data, txtfile, compress=False, debug=True):
     try:
-        f = open(txtfile, 'w')
+        if compress:
+            txtfile = str(txtfile) + '.gz'
+            f = gzip.open(txtfile, 'wt')
+        else:
+            f = open(txtfile, 'w')
         tmp = array2str(array=read_data, sep='\n')
         f.write(tmp)
-        if compress:
-            os.system('gzip ' + str (txtfile) )
         if debug:
             print ("Written " + str(txtfile) )
     except IOError:
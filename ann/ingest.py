@@ -0,0 +1,120 @@
+# ingest.py
+#
+# Streaming input from S3
+#
+# An S3Input reads the body of the input object as it downloads, so that the
+# first records are annotated while the rest are still on their way. What is
+# read can be spooled to a local file as well, for jobs that are run again
+# from disk. A body that breaks off is picked up again with a ranged GET of
+# the same object version from the first byte not read yet.
+#
+##
+
+import io
+import gzip
+import time
+
+from botocore.exceptions import BotoCoreError
+
+import bgzf
+
+DEFAULT_RETRIES = 3
+READ_SIZE = 1024 * 1024
+
+
+"""Raw byte stream of the S3 object bucket/key, spooled to spool if given
+"""
+class S3Input(io.RawIOBase):
+    def __init__(self, bucket, key, s3, spool=None, retries=DEFAULT_RETRIES):
+        self.bucket = bucket
+        self.key = key
+        self.s3 = s3
+        self.retries = retries
+        self.spoolPath = spool
+        self.spool = open(spool, 'wb') if spool else None
+        self.start = time.time()
+        response = s3.get_object(Bucket=bucket, Key=key)
+        self.body = response['Body']
+        self.size = response['ContentLength']
+        self.etag = response['ETag']
+        self.received = 0
+        self.reconnects = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.readBody(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    """Reads up to size bytes of the body; a body that fails, or ends
+       before the object does, is opened again where it broke off
+    """
+    def readBody(self, size):
+        attempt = 0
+        while True:
+            try:
+                data = self.body.read(size)
+                if (len(data) == 0) and (self.received < self.size):
+                    raise IOError(f"Body ended at byte {self.received} of " + \
+                        f"{self.size}")
+                break
+            except (IOError, BotoCoreError) as e:
+                if (attempt >= self.retries):
+                    raise e
+                attempt = attempt + 1
+                print(f"Input stream of {self.key} broke off: {str(e)}; " + \
+                    f"reading on from byte {self.received}")
+                self.reopen()
+
+        self.received = self.received + len(data)
+        if self.spool is not None:
+            self.spool.write(data)
+        return data
+
+    def reopen(self):
+        self.body.close()
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+            Range=f"bytes={self.received}-", IfMatch=self.etag)
+        self.body = response['Body']
+        self.reconnects = self.reconnects + 1
+
+    def close(self):
+        if not self.closed:
+            self.body.close()
+            if self.spool is not None:
+                self.spool.close()
+        io.RawIOBase.close(self)
+
+    """Text lines of the input as they download; gzip and BGZF inputs are
+       decompressed on the way
+    """
+    def open(self):
+        fh = io.BufferedReader(self, READ_SIZE)
+        if (fh.peek(2)[:2] == bgzf.GZIP_MAGIC):
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=fh))
+        return io.TextIOWrapper(fh)
+
+    """Reads the whole input into path, for stages that read their input
+       from disk
+    """
+    def drain(self, path):
+        fh = None
+        if (path != self.spoolPath):
+            fh = open(path, 'wb')
+        while True:
+            data = self.readBody(READ_SIZE)
+            if (len(data) == 0):
+                break
+            if fh is not None:
+                fh.write(data)
+        if fh is not None:
+            fh.close()
+        self.close()
+
+    def printStats(self):
+        print(f"Input stream: {self.received} of {self.size} bytes in " + \
+            f"{time.time() - self.start:.3f}s, {self.reconnects} reconnects")
+
+### EOF
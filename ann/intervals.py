@@ -0,0 +1,386 @@
+# intervals.py
+#
+# In-memory interval index for the region-overlap reference tables
+#
+##
+
+import os
+import sys
+import pickle
+
+import numpy as np
+
+import overlaps
+
+"""Tables answered by IntervalIndex, in the order they are preloaded,
+   with the names of their chrom, start and end columns
+"""
+OVERLAP_TABLES = [
+    ('cytoBand', 'chrom', 'chromStart', 'chromEnd'),
+    ('targetScanS', 'chrom', 'chromStart', 'chromEnd'),
+    ('hugo', 'chrom', 'chromStart', 'chromEnd'),
+    ('gadAll', 'chromosome', 'chromStart', 'chromEnd'),
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd'),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart', 'chromEnd'),
+    ('mcCarroll_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('conrad_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+]
+
+"""Tables answered by PointIndex, with the names of their chrom and
+   position columns. dbSNP is only indexed when asked for by name.
+"""
+POINT_TABLES = [
+    ('gwasCatalog', 'chrom', 'chromEnd'),
+    ('dbSNP', 'CHR', 'POS'),
+]
+DEFAULT_POINT_TABLES = ['gwasCatalog']
+
+"""Order of the rows of the tables queried by range
+   Stages that keep the first row over a position, or join the rows over
+   it, depend on the order the rows come in, and a bin condition can change
+   the order a query returns them in. Queries, the indexes and the reference
+   store all return rows in this order: the coordinates, then the columns
+   stages read (those of gadAll and hugo by position).
+"""
+ROW_ORDER = {
+    'refGene': 'txStart, txEnd, name, name2, cdsStart, cdsEnd, exonStarts, ' + \
+        'exonEnds',
+    'cpgIslandExt': 'chromStart, chromEnd, name',
+    'gwasCatalog': 'chromStart, chromEnd, pubMedID, trait',
+    'cytoBand': 'chromStart, chromEnd, name',
+    'gadAll': 'chromStart, chromEnd, 4',
+    'targetScanS': 'chromStart, chromEnd, name',
+    'hugo': 'chromStart, chromEnd, 6, 7',
+    'genomicSuperDups': 'chromStart, chromEnd, otherChrom, otherStart, ' + \
+        'otherEnd',
+    'tfbsConsSites': 'chromStart, chromEnd, name',
+}
+
+# Indexes loaded by this process, by table name
+_indexes = {}
+
+
+"""ORDER BY clause of a query on table, after the columns in first; '' for
+   tables whose stages do not depend on the order of their rows
+"""
+def orderClause(table, first=()):
+    if table.startswith('tfbsConsSites'):
+        table = 'tfbsConsSites'
+    if table not in ROW_ORDER:
+        return ''
+    return ' order by ' + ', '.join(list(first) + [ROW_ORDER[table]])
+
+
+"""Key of a chromosome name in the indexes and the reference store
+   The reference database compares chrom columns without case, so the
+   in-memory lookups do too.
+"""
+def chromKey(chrom):
+    return str(chrom).upper()
+
+
+"""Implicit augmented interval tree over the intervals of one chromosome
+   Intervals are half-open [start, end), sorted by start and laid out as an
+   implicit binary tree in which every node keeps the largest end of its
+   subtree (the layout used by cgranges). A point query costs O(log n + k).
+"""
+class IntervalTree(object):
+    def __init__(self, intervals):
+        intervals.sort(key=lambda iv: iv[0])
+        self.starts = [iv[0] for iv in intervals]
+        self.ends = [iv[1] for iv in intervals]
+        self.ids = [iv[2] for iv in intervals]
+        self.maxs = list(self.ends)
+        self.maxLevel = self.build()
+
+    def build(self):
+        n = len(self.starts)
+        if (n == 0):
+            return -1
+
+        ends = self.ends
+        maxs = self.maxs
+        last_i = 0
+        last = 0
+        for i in range(0, n, 2):
+            last_i = i
+            last = ends[i]
+
+        k = 1
+        while ((1 << k) <= n):
+            x = 1 << (k - 1)
+            i0 = (x << 1) - 1
+            step = x << 2
+            for i in range(i0, n, step):
+                el = maxs[i - x]
+                er = maxs[i + x] if (i + x < n) else last
+                maxs[i] = max(ends[i], el, er)
+
+            last_i = (last_i - x) if ((last_i >> k) & 1) else (last_i + x)
+            if (last_i < n) and (maxs[last_i] > last):
+                last = maxs[last_i]
+            k = k + 1
+
+        return k - 1
+
+    """Ids of the intervals that overlap [start, end)
+    """
+    def overlap(self, start, end):
+        n = len(self.starts)
+        if (n == 0):
+            return []
+
+        starts = self.starts
+        ends = self.ends
+        maxs = self.maxs
+        hits = []
+        stack = [((1 << self.maxLevel) - 1, self.maxLevel, 0)]
+
+        while (len(stack) > 0):
+            x, k, w = stack.pop()
+            if (k <= 3):
+                # Small subtree, scan it
+                i0 = x >> k << k
+                i1 = min(i0 + (1 << (k + 1)) - 1, n)
+                for i in range(i0, i1):
+                    if (starts[i] >= end):
+                        break
+                    if (start < ends[i]):
+                        hits.append(self.ids[i])
+            elif (w == 0):
+                # Left child first; it may be out of range
+                y = x - (1 << (k - 1))
+                stack.append((x, k, 1))
+                if (y >= n) or (maxs[y] > start):
+                    stack.append((y, k - 1, 0))
+            elif (x < n) and (starts[x] < end):
+                if (start < ends[x]):
+                    hits.append(self.ids[x])
+                stack.append((x + (1 << (k - 1)), k - 1, 0))
+
+        return hits
+
+
+"""Per-chromosome index of a table with closed [chromStart, chromEnd]
+   intervals. Lookups return the matching rows in table order, i.e. the
+   order a query against the table returns them in.
+"""
+class IntervalIndex(object):
+    def __init__(self, table, rows, chromCol, startCol, endCol):
+        self.table = table
+        self.rows = rows
+        self.size = rowsSize(rows)
+        self.trees = {}
+
+        intervals = {}
+        for i in range(0, len(rows)):
+            row = rows[i]
+            intervals.setdefault(chromKey(row[chromCol]), []).append(
+                (int(row[startCol]), int(row[endCol]) + 1, i))
+
+        for chrom in intervals:
+            self.trees[chrom] = IntervalTree(intervals[chrom])
+
+        # Sorted arrays for overlapsBatch, built on first use
+        self.arrays = {}
+
+    """Rows where chromStart <= pos <= chromEnd
+    """
+    def overlaps(self, chrom, pos):
+        tree = self.trees.get(chromKey(chrom))
+        if tree is None:
+            return ()
+        pos = int(pos)
+        return tuple([self.rows[i] for i in sorted(tree.overlap(pos, pos + 1))])
+
+    def getArrays(self, chrom):
+        if chrom not in self.arrays:
+            tree = self.trees[chrom]
+            starts = np.array(tree.starts, dtype=np.int64)
+            ends = np.array(tree.ends, dtype=np.int64) - 1
+            self.arrays[chrom] = (starts, ends,
+                overlaps.lengthClasses(starts, ends),
+                np.array(tree.ids, dtype=np.int64))
+        return self.arrays[chrom]
+
+    """overlaps() for a list of positions on one chromosome, at once
+    """
+    def overlapsBatch(self, chrom, positions):
+        chrom = chromKey(chrom)
+        if chrom not in self.trees:
+            return [()] * len(positions)
+
+        starts, ends, classes, ids = self.getArrays(chrom)
+        hits, idx = overlaps.pointOverlaps(positions, starts, ends,
+            classes=classes)
+        groups = overlaps.groupHits(len(positions), hits, idx, ids[idx])
+        return [tuple([self.rows[i] for i in ids[g].tolist()]) for g in groups]
+
+
+"""Hash index of a table queried by exact position
+   Maps (chrom, pos) to the offsets of the matching rows, kept in table
+   order. Saved with pickle, so a process loads it instead of reading
+   the table.
+"""
+class PointIndex(object):
+    def __init__(self, table, rows, columns, chromCol, posCol):
+        self.table = table
+        self.rows = rows
+        self.columns = columns
+        self.size = rowsSize(rows)
+        self.offsets = {}
+        for i in range(0, len(rows)):
+            key = (chromKey(rows[i][chromCol]), int(rows[i][posCol]))
+            self.offsets.setdefault(key, []).append(i)
+
+    """Rows where the position column = pos
+    """
+    def get(self, chrom, pos):
+        offsets = self.offsets.get((chromKey(chrom), int(pos)))
+        if offsets is None:
+            return ()
+        return tuple([self.rows[i] for i in offsets])
+
+    def columnIndex(self, name):
+        return [c.lower() for c in self.columns].index(name.lower())
+
+    # Only plain data is pickled, so files do not depend on the module name
+    def save(self, path):
+        fh = open(path, 'wb')
+        pickle.dump((self.table, self.rows, self.columns, self.size,
+            self.offsets), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        fh.close()
+
+    @staticmethod
+    def load(path):
+        fh = open(path, 'rb')
+        idx = PointIndex.__new__(PointIndex)
+        idx.table, idx.rows, idx.columns, idx.size, idx.offsets = \
+            pickle.load(fh)
+        fh.close()
+        return idx
+
+
+def pointIndexPath(index_dir, table):
+    return os.path.join(index_dir, table + '.idx')
+
+
+"""Builds the PointIndex of table from the reference database
+"""
+def buildPointIndex(cursor, table):
+    chromName, posName = [(c, p) for (t, c, p) in POINT_TABLES
+        if t == table][0]
+    cursor.execute('select * from ' + table + \
+        orderClause(table, [chromName]) + ';')
+    rows = cursor.fetchall()
+    return PointIndex(table, rows, [str(d[0]) for d in cursor.description],
+        getColumnIndex(cursor, chromName), getColumnIndex(cursor, posName))
+
+
+"""Loads the PointIndexes saved in index_dir
+   Indexes are kept for the life of the process.
+"""
+def loadPointIndexes(index_dir):
+    for (table, chromName, posName) in POINT_TABLES:
+        path = pointIndexPath(index_dir, table)
+        if (table not in _indexes) and os.path.exists(path):
+            _indexes[table] = PointIndex.load(path)
+            print(f"{table}: {len(_indexes[table].offsets)} positions loaded " + \
+                f"(~{_indexes[table].size // (1024 * 1024)} MB)")
+    return dict([(t, _indexes[t]) for (t, c, p) in POINT_TABLES
+        if t in _indexes])
+
+
+"""Approximate memory held by a list of rows
+"""
+def rowsSize(rows):
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size = size + sys.getsizeof(row) + sum([sys.getsizeof(x) for x in row])
+    return size
+
+
+def getColumnIndex(cursor, name):
+    names = [str(d[0]).lower() for d in cursor.description]
+    return names.index(name.lower())
+
+
+"""Index of cpgIslandExt for the promoter lookups of getGenes
+   The table is small, so it is always loaded, with a single query, and
+   kept for the life of the process.
+"""
+def loadCpgIslands(cursor):
+    if 'cpgIslandExt' not in _indexes:
+        cursor.execute('select chrom, chromStart, chromEnd, name from ' + \
+            'cpgIslandExt' + orderClause('cpgIslandExt', ['chrom']) + ';')
+        rows = cursor.fetchall()
+        _indexes['cpgIslandExt'] = IntervalIndex('cpgIslandExt', rows, 0, 1, 2)
+    return _indexes['cpgIslandExt']
+
+
+"""Loads the overlap tables into IntervalIndexes while they fit in
+   memory_budget_mb; tables that do not fit stay remote
+   The size of a table is estimated from a sample of its rows before it is
+   loaded. Indexes are kept for the life of the process; the ones of
+   tables are returned.
+"""
+def loadIndexes(cursor, memory_budget_mb, tables=OVERLAP_TABLES,
+    sample_size=100):
+
+    budget = int(memory_budget_mb) * 1024 * 1024
+    used = sum([idx.size for idx in _indexes.values()])
+
+    for (table, chromName, startName, endName) in tables:
+        if table in _indexes:
+            continue
+
+        cursor.execute('select count(*) from ' + table + ';')
+        count = int(cursor.fetchone()[0])
+        cursor.execute('select * from ' + table + ' limit ' + \
+            str(sample_size) + ';')
+        sample = cursor.fetchall()
+        estimate = 0
+        if (len(sample) > 0):
+            estimate = int(rowsSize(sample) / float(len(sample)) * count)
+
+        if (used + estimate > budget):
+            print(f"{table}: ~{estimate // (1024 * 1024)} MB, stays remote")
+            continue
+
+        cursor.execute('select * from ' + table + \
+            orderClause(table, [chromName]) + ';')
+        rows = cursor.fetchall()
+        idx = IntervalIndex(table, rows,
+            getColumnIndex(cursor, chromName),
+            getColumnIndex(cursor, startName),
+            getColumnIndex(cursor, endName))
+        used = used + idx.size
+        _indexes[table] = idx
+        print(f"{table}: {len(rows)} intervals preloaded " + \
+            f"(~{idx.size // (1024 * 1024)} MB)")
+
+    return dict([(t, _indexes[t]) for (t, c, s, e) in tables
+        if t in _indexes])
+
+
+if __name__ == '__main__':
+    import utils as u
+
+    if len(sys.argv) > 1:
+        index_dir = sys.argv[1]
+        tables = sys.argv[2:] or DEFAULT_POINT_TABLES
+        os.makedirs(index_dir, exist_ok=True)
+
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        for table in tables:
+            idx = buildPointIndex(cursor, table)
+            idx.save(pointIndexPath(index_dir, table))
+            print(f"{table} - done.")
+        conn.close()
+
+    else:
+        print("Please provide the directory to write the point indexes to.")
+
+### EOF
@@ -0,0 +1,98 @@
+# lookahead.py
+#
+# Lookahead executor for the per-record database lookups of the stages
+#
+# Stages that look records up with one query each (see lookupKeys in
+# annotate.py) hand the keys of a window of records to the Lookahead before
+# the window is annotated. The lookups are split over a few threads, each
+# with its own connection from the pool, and run while the window before it
+# is annotated. The rows are then put in the annotator's prefetched map, so
+# the per-record logic finds them there, in input order, instead of waiting
+# on the database one record at a time. The stage being annotated holds a
+# connection of the same pool, so there is one thread fewer than the pool
+# has connections, at most.
+#
+##
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import utils as u
+import annotate as ann
+
+DEFAULT_DEPTH = 500
+DEFAULT_CONNECTIONS = 4
+
+
+"""Lookups submitted for one window, by annotator
+"""
+class LookaheadWindow(object):
+    def __init__(self, lookahead):
+        self.lookahead = lookahead
+        self.pending = {}
+
+    """Waits for the lookups of annotator and puts their rows in its
+       prefetched map
+    """
+    def fill(self, annotator):
+        if id(annotator) not in self.pending:
+            return
+        start = time.time()
+        for keys, future in self.pending.pop(id(annotator)):
+            rows = future.result()
+            for i in range(0, len(keys)):
+                annotator.prefetched[keys[i]] = rows[i]
+        self.lookahead.wait = self.lookahead.wait + (time.time() - start)
+
+
+class Lookahead(object):
+    def __init__(self, depth=DEFAULT_DEPTH, connections=DEFAULT_CONNECTIONS):
+        self.depth = int(depth)
+        size = u.getPool().size
+        if (size < 2):
+            raise ValueError(f"Lookahead needs a connection pool of 2 or " + \
+                f"more (ANN_DB_POOL_SIZE is {size})")
+        self.connections = min(max(int(connections), 1), size - 1)
+        if (self.connections < int(connections)):
+            print(f"Lookahead: {self.connections} connections, the pool " + \
+                f"has {size} and the stage holds one")
+        self.executor = ThreadPoolExecutor(max_workers=self.connections)
+        self.lookups = 0
+        self.wait = 0.0
+
+    """Runs the lookups of keys on one pooled connection
+    """
+    def lookupAll(self, annotator, keys):
+        conn = u.db_pool_connect()
+        try:
+            cursor = conn.cursor()
+            return [annotator.lookup(cursor, key) for key in keys]
+        finally:
+            conn.close()
+
+    """Starts the lookups of a window of lines for every annotator;
+       variants the cache has an entry for are not looked up
+    """
+    def submit(self, annotators, lines, sep='\t', cache=None):
+        window = LookaheadWindow(self)
+        for annotator in annotators:
+            keys = annotator.lookupKeys(ann.linesToPrefetch(annotator, lines,
+                sep=sep, cache=cache), sep=sep)
+            keys = list(dict.fromkeys(keys))
+            if (len(keys) == 0):
+                continue
+            size = -(-len(keys) // self.connections)
+            window.pending[id(annotator)] = [(keys[i:i + size],
+                self.executor.submit(self.lookupAll, annotator,
+                keys[i:i + size])) for i in range(0, len(keys), size)]
+            self.lookups = self.lookups + len(keys)
+        return window
+
+    def close(self):
+        self.executor.shutdown()
+
+    def printStats(self):
+        print(f"Lookahead: {self.lookups} lookups over " + \
+            f"{self.connections} connections, waited {self.wait:.3f}s")
+
+### EOF
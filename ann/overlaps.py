@@ -0,0 +1,98 @@
+# overlaps.py
+#
+# Vectorized point-in-interval engine for annotating a chunk of records at once
+#
+# Intervals of one chromosome are closed [start, end] and sorted by start.
+# They are split into classes by length, each class holding lengths up to
+# twice the shortest it can hold. In a class whose intervals are at most
+# maxlen long, the intervals that can hold a position form one contiguous
+# run: those that start from maxlen before the position up to the position.
+# Both bounds come from searchsorted, so a whole chunk of positions is
+# resolved with a handful of array operations per class. A few long
+# intervals, such as a CNV over a whole chromosome, are in classes of their
+# own and do not widen the runs of the short ones.
+#
+##
+
+import numpy as np
+
+
+"""Length classes of intervals sorted by start: for every class, the
+   indices of its intervals, their starts and ends, and its longest length
+"""
+def lengthClasses(starts, ends):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if (len(starts) == 0):
+        return []
+    lengths = np.maximum(ends - starts, 0)
+    # Class k holds lengths from 2^(k-1) up to 2^k - 1; class 0 length 0
+    classes = np.zeros(len(lengths), dtype=np.int64)
+    positive = lengths > 0
+    classes[positive] = np.frexp(lengths[positive].astype(np.float64))[1]
+
+    result = []
+    for k in np.unique(classes).tolist():
+        idx = np.nonzero(classes == k)[0]
+        result.append((idx, starts[idx], ends[idx], int(lengths[idx].max())))
+    return result
+
+
+"""(window, interval) pairs for intervals with start <= hi and lo <= end
+   starts must be sorted; classes is lengthClasses(starts, ends). Pairs
+   come back ordered by window, then by interval.
+"""
+def rangeOverlaps(los, his, starts, ends, classes=None):
+    los = np.asarray(los, dtype=np.int64)
+    his = np.asarray(his, dtype=np.int64)
+    empty = np.zeros(0, dtype=np.int64)
+    if (len(starts) == 0) or (len(los) == 0):
+        return empty, empty
+    if classes is None:
+        classes = lengthClasses(starts, ends)
+
+    windows = []
+    intervals = []
+    for idx, classStarts, classEnds, maxlen in classes:
+        hi = np.searchsorted(classStarts, his, side='right')
+        lo = np.minimum(np.searchsorted(classStarts, los - maxlen,
+            side='left'), hi)
+        counts = hi - lo
+        total = int(counts.sum())
+        if (total == 0):
+            continue
+
+        windowIdx = np.repeat(np.arange(len(los), dtype=np.int64), counts)
+        firsts = np.cumsum(counts) - counts
+        classIdx = np.repeat(lo, counts) + \
+            (np.arange(total, dtype=np.int64) - np.repeat(firsts, counts))
+
+        keep = classEnds[classIdx] >= los[windowIdx]
+        windows.append(windowIdx[keep])
+        intervals.append(idx[classIdx[keep]])
+
+    if (len(windows) == 0):
+        return empty, empty
+    windowIdx = np.concatenate(windows)
+    intervalIdx = np.concatenate(intervals)
+    order = np.lexsort((intervalIdx, windowIdx))
+    return windowIdx[order], intervalIdx[order]
+
+
+"""(position, interval) pairs for intervals with start <= pos <= end
+"""
+def pointOverlaps(positions, starts, ends, classes=None):
+    return rangeOverlaps(positions, positions, starts, ends, classes=classes)
+
+
+"""Splits pairs into the intervals of each of n windows, ordered by keys
+   (one key per pair, e.g. the row's position in its table)
+"""
+def groupHits(n, windowIdx, intervalIdx, keys):
+    order = np.lexsort((keys, windowIdx))
+    windowIdx = windowIdx[order]
+    intervalIdx = intervalIdx[order]
+    bounds = np.searchsorted(windowIdx, np.arange(n + 1), side='left')
+    return [intervalIdx[bounds[i]:bounds[i + 1]] for i in range(0, n)]
+
+### EOF
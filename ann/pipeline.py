@@ -0,0 +1,258 @@
+# pipeline.py
+#
+# Order-preserving reader / annotator / writer pipeline
+#
+# A reader thread reads the input in numbered chunks onto a bounded work
+# queue. A pool of workers, threads for stages that wait on the database or
+# processes for stages that are CPU-bound, annotate chunks as they come and
+# put them on a bounded result queue; the writer puts them back in input
+# order. The reader only gets ahead of the writer by a fixed number of
+# chunks, so memory is bounded by the chunk size, not by the input. Every
+# part of the pipeline keeps how long it stalled on its queues and how deep
+# the queue it reads from was (see PipelineStats).
+#
+##
+
+import time
+import queue
+import threading
+import traceback
+import multiprocessing
+
+import file_utils as fu
+import bgzf
+import utils as u
+import annotate as ann
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_QUEUE_DEPTH = 4
+# Seconds the writer waits for a chunk before it checks the workers are alive
+LIVENESS_INTERVAL = 5
+
+
+"""Depth of a queue; 0 where the platform cannot tell
+"""
+def queueDepth(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return 0
+
+
+"""What one part of the pipeline did: the chunks it handled, the time it
+   stalled waiting for a chunk and on a full queue, and the depth of the
+   queue it reads from, sampled on every get that returns a chunk
+"""
+class PipelineStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.chunks = 0
+        self.get_stall = 0.0
+        self.put_stall = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.samples = 0
+
+    def get(self, q, timeout=None):
+        depth = queueDepth(q)
+        start = time.time()
+        try:
+            item = q.get(timeout=timeout)
+        finally:
+            self.get_stall = self.get_stall + (time.time() - start)
+        self.depth_total = self.depth_total + depth
+        self.depth_max = max(self.depth_max, depth)
+        self.samples = self.samples + 1
+        return item
+
+    def put(self, q, item):
+        start = time.time()
+        q.put(item)
+        self.put_stall = self.put_stall + (time.time() - start)
+
+    def __str__(self):
+        depth = self.depth_total / float(max(self.samples, 1))
+        return f"{self.name}: {self.chunks} chunks, " + \
+            f"stalled {self.get_stall:.3f}s for input, " + \
+            f"{self.put_stall:.3f}s on a full queue, " + \
+            f"queue depth {depth:.1f} mean, {self.depth_max} max"
+
+
+"""Reads infile onto the chunks queue; a chunk is only read once there is
+   a slot for it, i.e. the writer is less than the slots behind
+"""
+def read(infile, source, chunk_size, chunks, results, workers, slots, stats):
+    try:
+        if source is not None:
+            fh = source.open()
+        else:
+            fh = bgzf.openText(infile)
+        seq = 0
+        for batch in fu.readBatches(fh, chunk_size):
+            start = time.time()
+            slots.acquire()
+            stats.put_stall = stats.put_stall + (time.time() - start)
+            stats.put(chunks, ('chunk', seq, [line.strip() for line in batch]))
+            stats.chunks = stats.chunks + 1
+            seq = seq + 1
+        fh.close()
+        for i in range(0, workers):
+            chunks.put(('end',))
+    except Exception:
+        results.put(('error', 'reader', traceback.format_exc()))
+
+
+"""Worker loop: annotates chunks until the end marker, then puts
+   the counts of its annotators on results
+   setup returns the annotators of the worker, its annotation cache or
+   None, and a function that releases what setup opened.
+"""
+def work(n, setup, sep, chunks, results):
+    stats = PipelineStats('worker ' + str(n))
+    try:
+        annotators, cache, release = setup()
+        base = [a.getCounts() for a in annotators]
+        while True:
+            item = stats.get(chunks)
+            if (item[0] == 'end'):
+                break
+            lines = ann.annotateBatch(item[2], annotators, sep=sep, cache=cache)
+            stats.chunks = stats.chunks + 1
+            stats.put(results, ('chunk', item[1], lines))
+        if cache is not None:
+            cache.flush()
+        release()
+        results.put(('end', [a.getCounts() for a in annotators], base, stats))
+    except Exception:
+        results.put(('error', stats.name, traceback.format_exc()))
+
+
+def workProcess(n, setup, sep, chunks, results):
+    # The pool of the parent is not for this process
+    u.resetPool()
+    work(n, setup, sep, chunks, results)
+
+
+"""Moves what worker processes put on results onto received, until every
+   worker ended or one failed
+   A worker process that is killed may leave part of a chunk on results,
+   and a get waits for the rest of it for ever; this thread is left waiting
+   then, instead of the writer.
+"""
+def collect(results, received, workers):
+    ended = 0
+    while (ended < workers):
+        item = results.get()
+        received.put(item)
+        if (item[0] == 'error'):
+            break
+        if (item[0] == 'end'):
+            ended = ended + 1
+
+
+"""Annotates infile into outfile with workers running setup in a pipeline
+   (see above). Returns, for every worker, the counts of its annotators and
+   their counts when they were fresh, and the PipelineStats of the reader,
+   the workers and the writer. With compress outfile is written as BGZF.
+   Given a source (see ingest.py), the input is read from its stream.
+"""
+def run(infile, outfile, setup, workers, processes=False, sep='\t',
+    chunk_size=DEFAULT_CHUNK_SIZE, depth=DEFAULT_QUEUE_DEPTH, compress=False,
+    source=None):
+
+    if processes:
+        chunks = multiprocessing.Queue(depth)
+        results = multiprocessing.Queue(depth)
+        pool = [multiprocessing.Process(target=workProcess,
+            args=(n, setup, sep, chunks, results), daemon=True)
+            for n in range(0, workers)]
+    else:
+        chunks = queue.Queue(depth)
+        results = queue.Queue(depth)
+        pool = [threading.Thread(target=work,
+            args=(n, setup, sep, chunks, results), daemon=True)
+            for n in range(0, workers)]
+
+    # Worker processes are forked before the reader thread starts, as a
+    # process forked while a thread runs may inherit a lock it held
+    for w in pool:
+        w.start()
+
+    # Chunks read but not yet written
+    slots = threading.Semaphore(2 * depth + workers)
+    readerStats = PipelineStats('reader')
+    reader = threading.Thread(target=read, args=(infile, source, chunk_size,
+        chunks, results, workers, slots, readerStats), daemon=True)
+    reader.start()
+
+    received = results
+    if processes:
+        received = queue.Queue()
+        threading.Thread(target=collect, args=(results, received, workers),
+            daemon=True).start()
+
+    def fail(message):
+        fh_out.close()
+        if processes:
+            for w in pool:
+                w.terminate()
+            # What is left on the queues is not flushed at exit
+            chunks.cancel_join_thread()
+            results.cancel_join_thread()
+        raise RuntimeError(message)
+
+    writerStats = PipelineStats('writer')
+    pending = {}
+    nextSeq = 0
+    ended = []
+    lost = 0
+    fh_out = bgzf.openText(outfile, 'w', compress=compress)
+    while (len(ended) < workers):
+        # A worker that exits without putting its end or an error, e.g. one
+        # that is killed, would leave the writer waiting for ever. Worker
+        # processes that end or fail exit with 0; otherwise a worker is
+        # only given up on after another interval without a chunk, so that
+        # what it put before it exited is read first.
+        try:
+            item = writerStats.get(received, timeout=LIVENESS_INTERVAL)
+        except queue.Empty:
+            if processes:
+                killed = [w for w in pool if w.exitcode not in (None, 0)]
+                if (len(killed) > 0):
+                    fail("Pipeline worker exited before it ended, exit " + \
+                        f"codes {', '.join([str(w.exitcode) for w in killed])}")
+            dead = len([w for w in pool if not w.is_alive()]) - len(ended)
+            if (lost > 0) and (dead > 0):
+                fail("Pipeline worker exited before it ended")
+            lost = dead
+            continue
+        lost = 0
+
+        if (item[0] == 'error'):
+            fail(f"Pipeline {item[1]} failed:\n{item[2]}")
+        if (item[0] == 'end'):
+            ended.append(item[1:])
+            continue
+
+        pending[item[1]] = item[2]
+        while nextSeq in pending:
+            for line in pending.pop(nextSeq):
+                fh_out.write(line + '\n')
+            writerStats.chunks = writerStats.chunks + 1
+            nextSeq = nextSeq + 1
+            slots.release()
+    fh_out.close()
+
+    reader.join()
+    for w in pool:
+        w.join()
+
+    stats = [readerStats] + [e[2] for e in ended] + [writerStats]
+    return [(e[0], e[1]) for e in ended], stats
+
+
+def printStats(stats):
+    for s in stats:
+        print(f"Pipeline {s}")
+
+### EOF
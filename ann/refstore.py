@@ -0,0 +1,325 @@
+# refstore.py
+#
+# Local, memory-mapped columnar copy of the annotator reference tables
+#
+# Every table is stored per chromosome as NumPy columns sorted by position:
+#
+#   <root>/<table>/meta.json
+#   <root>/<table>/<n>/<column>.npy      n is the chromosome's position in meta
+#
+# Columns are opened with mmap, so worker processes on one instance share a
+# single page-cache copy. Build the store with:
+#
+#   python refstore.py <root> [table ...]
+#
+##
+
+import os
+import sys
+import json
+from decimal import Decimal
+
+import numpy as np
+
+import overlaps
+import intervals
+
+"""Tables in the store: chrom column, sort key and, for interval tables,
+   the end column. The tfbsConsSites tables are split by chromosome
+   already and are stored as a single chromosome.
+"""
+TABLES = {
+    'dbSNP': ('CHR', 'POS', None),
+    'chrom_pos_equal_base': ('CHR', 'start', None),
+    'chrom_pos_equal_nobase': ('CHR', 'start', None),
+    'chrom_pos_unequal': ('CHR', 'start', 'end'),
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromEnd', None),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+}
+
+for c in [str(i) for i in range(1, 23)] + ['X', 'Y']:
+    TABLES['tfbsConsSites' + c] = (None, 'chromStart', 'chromEnd')
+
+
+"""Kind of a column, from its first non-NULL value
+"""
+def getKind(values):
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, bool) or isinstance(v, int):
+            return 'int'
+        if isinstance(v, float):
+            return 'float'
+        if isinstance(v, Decimal):
+            return 'decimal'
+        if isinstance(v, (bytes, bytearray)):
+            return 'bytes'
+        return 'str'
+    return 'none'
+
+
+def toArray(values, kind):
+    if (kind == 'int'):
+        return np.array([0 if v is None else int(v) for v in values],
+            dtype=np.int64)
+    if (kind == 'float'):
+        return np.array([0.0 if v is None else float(v) for v in values],
+            dtype=np.float64)
+    if (kind == 'bytes'):
+        return np.array([b'' if v is None else bytes(v) for v in values],
+            dtype='S')
+    # str, decimal and anything else (dates) keep their text
+    return np.array([b'' if v is None else str(v).encode('utf-8')
+        for v in values], dtype='S')
+
+
+"""Python values of a column slice; ints, floats and bytes come back as
+   they are from tolist()
+"""
+def fromArray(array, kind):
+    values = array.tolist()
+    if (kind == 'str'):
+        return [v.decode('utf-8') for v in values]
+    if (kind == 'decimal'):
+        return [Decimal(v.decode('utf-8')) for v in values]
+    if (kind == 'none'):
+        return [None] * len(values)
+    return values
+
+
+"""Exports one table from the reference database into the store
+"""
+def buildTable(cursor, root, table):
+    chromName, keyName, endName = TABLES[table]
+    tabledir = os.path.join(root, table)
+    os.makedirs(tabledir, exist_ok=True)
+
+    # Names of every chromosome, by key
+    chromNames = {'': []}
+    if chromName is not None:
+        chromNames = {}
+        cursor.execute('select distinct ' + chromName + ' from ' + table + ';')
+        for r in cursor.fetchall():
+            chromNames.setdefault(intervals.chromKey(r[0]), []).append(
+                str(r[0]))
+    chroms = sorted(chromNames.keys())
+
+    meta = {'table': table, 'chrom': chromName, 'key': keyName,
+        'end': endName, 'columns': [], 'chroms': {}}
+
+    for n in range(0, len(chroms)):
+        chrom = chroms[n]
+        if chromName is None:
+            cursor.execute('select * from ' + table + \
+                intervals.orderClause(table) + ';')
+            rows = cursor.fetchall()
+        else:
+            rows = []
+            for name in chromNames[chrom]:
+                cursor.execute('select * from ' + table + ' where ' + \
+                    chromName + '=%s' + intervals.orderClause(table) + ';',
+                    [name])
+                rows.extend(cursor.fetchall())
+        names = [str(d[0]) for d in cursor.description]
+        meta['columns'] = names
+
+        keyIdx = names.index(keyName)
+        keys = np.array([int(r[keyIdx]) for r in rows], dtype=np.int64)
+        # Rows with the same key keep the order the database returned them in
+        order = np.argsort(keys, kind='stable')
+
+        chromdir = os.path.join(tabledir, str(n))
+        os.makedirs(chromdir, exist_ok=True)
+        np.save(os.path.join(chromdir, '_order.npy'), order.astype(np.int64))
+
+        kinds = []
+        nulls = []
+        for i in range(0, len(names)):
+            values = [rows[j][i] for j in order]
+            kind = getKind(values)
+            kinds.append(kind)
+            np.save(os.path.join(chromdir, str(i) + '.npy'),
+                toArray(values, kind))
+            if any([v is None for v in values]):
+                nulls.append(i)
+                np.save(os.path.join(chromdir, str(i) + '.null.npy'),
+                    np.array([v is None for v in values], dtype=bool))
+
+        meta['chroms'][chrom] = {'dir': str(n), 'rows': len(rows),
+            'kinds': kinds, 'nulls': nulls}
+
+    fh = open(os.path.join(tabledir, 'meta.json'), 'w')
+    json.dump(meta, fh)
+    fh.close()
+
+
+"""Stands in for the database connection of a stage that reads the store
+"""
+class StoreConnection(object):
+    def cursor(self):
+        return None
+
+    def close(self):
+        pass
+
+
+"""Read side of the store
+   Lookups return rows as tuples of the same Python types pymysql returns,
+   in the order the database returns them for the chromosome.
+"""
+class ReferenceStore(object):
+    def __init__(self, root):
+        self.root = root
+        self.meta = {}
+        self.chroms = {}
+
+    def connect(self):
+        return StoreConnection()
+
+    def getMeta(self, table):
+        if table not in self.meta:
+            fh = open(os.path.join(self.root, table, 'meta.json'))
+            meta = json.load(fh)
+            fh.close()
+            # Stores built before chromosomes were keyed without case
+            meta['chroms'] = dict([(intervals.chromKey(c), meta['chroms'][c])
+                for c in meta['chroms']])
+            self.meta[table] = meta
+        return self.meta[table]
+
+    def columnIndex(self, table, name):
+        names = [c.lower() for c in self.getMeta(table)['columns']]
+        return names.index(name.lower())
+
+    """Memory-mapped columns of one chromosome, or None
+    """
+    def getChrom(self, table, chrom):
+        meta = self.getMeta(table)
+        if meta['chrom'] is None:
+            chrom = ''
+        chrom = intervals.chromKey(chrom)
+        if (table, chrom) not in self.chroms:
+            info = meta['chroms'].get(chrom)
+            data = None
+            if info is not None and info['rows'] > 0:
+                chromdir = os.path.join(self.root, table, info['dir'])
+                data = {'info': info, 'columns': [], 'nulls': {}}
+                data['order'] = np.load(os.path.join(chromdir, '_order.npy'),
+                    mmap_mode='r')
+                for i in range(0, len(meta['columns'])):
+                    data['columns'].append(np.load(
+                        os.path.join(chromdir, str(i) + '.npy'), mmap_mode='r'))
+                for i in info['nulls']:
+                    data['nulls'][i] = np.load(
+                        os.path.join(chromdir, str(i) + '.null.npy'),
+                        mmap_mode='r')
+                meta_key = meta['columns'].index(meta['key'])
+                data['key'] = data['columns'][meta_key]
+                if meta['end'] is not None:
+                    data['end'] = data['columns'][meta['columns'].index(meta['end'])]
+            self.chroms[(table, chrom)] = data
+        return self.chroms[(table, chrom)]
+
+    """Rows at idx, in table order unless ordered is False
+    """
+    def getRows(self, table, data, idx, columns=None, ordered=True):
+        meta = self.getMeta(table)
+        if columns is None:
+            cols = range(0, len(meta['columns']))
+        else:
+            cols = [self.columnIndex(table, c) for c in columns]
+
+        idx = np.asarray(idx, dtype=np.int64)
+        if (len(idx) == 0):
+            return ()
+        # Table order for rows that share a key
+        if ordered:
+            idx = idx[np.argsort(data['order'][idx], kind='stable')]
+
+        kinds = data['info']['kinds']
+        columns = []
+        for c in cols:
+            values = fromArray(data['columns'][c][idx], kinds[c])
+            if c in data['nulls']:
+                isNull = data['nulls'][c][idx].tolist()
+                values = [None if n else v for (v, n) in zip(values, isNull)]
+            columns.append(values)
+        return tuple(zip(*columns))
+
+    """Rows where key = value
+    """
+    def equal(self, table, chrom, value, columns=None):
+        data = self.getChrom(table, chrom)
+        if data is None:
+            return ()
+        keys = data['key']
+        lo = int(np.searchsorted(keys, value, side='left'))
+        hi = int(np.searchsorted(keys, value, side='right'))
+        return self.getRows(table, data, np.arange(lo, hi), columns=columns)
+
+    """Rows where key - pad <= pos <= end + pad
+    """
+    def overlapping(self, table, chrom, pos, pad=0, columns=None):
+        data = self.getChrom(table, chrom)
+        if data is None:
+            return ()
+        if 'classes' not in data:
+            data['classes'] = overlaps.lengthClasses(data['key'], data['end'])
+        hits, idx = overlaps.rangeOverlaps([pos - pad], [pos + pad],
+            data['key'], data['end'], classes=data['classes'])
+        return self.getRows(table, data, idx, columns=columns)
+
+    """overlapping() for a list of positions on one chromosome, at once
+    """
+    def overlappingBatch(self, table, chrom, positions, pad=0, columns=None):
+        data = self.getChrom(table, chrom)
+        if data is None:
+            return [()] * len(positions)
+        if 'classes' not in data:
+            data['classes'] = overlaps.lengthClasses(data['key'], data['end'])
+
+        positions = np.asarray(positions, dtype=np.int64)
+        hits, idx = overlaps.rangeOverlaps(positions - pad, positions + pad,
+            data['key'], data['end'], classes=data['classes'])
+        groups = overlaps.groupHits(len(positions), hits, idx,
+            data['order'][idx])
+
+        idx = np.concatenate(groups) if len(groups) > 0 else idx
+        rows = self.getRows(table, data, idx, columns=columns, ordered=False)
+        result = []
+        first = 0
+        for g in groups:
+            result.append(tuple(rows[first:first + len(g)]))
+            first = first + len(g)
+        return result
+
+
+if __name__ == '__main__':
+    import utils as u
+
+    if len(sys.argv) > 1:
+        root = sys.argv[1]
+        tables = sys.argv[2:] or sorted(TABLES.keys())
+
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        for table in tables:
+            buildTable(cursor, root, table)
+            print(f"{table} - done.")
+        conn.close()
+
+    else:
+        print("Please provide the directory to build the reference store in.")
+
+### EOF
@@ -1,6 +1,11 @@
 import sys
 import time
+import json
+import hashlib
+import threading
 import driver
+import checkpoint
+import ingest
 import boto3
 import os
 from datetime import datetime
@@ -18,6 +23,40 @@ REGION = config['aws']['region']
 ANNOTATIONS_TABLE = config['dynamodb']['annotations_table']
 PREFIX = config['other']['prefix']
 topic_arn = config['sns']['topic_arn']
+FUSED = config.getboolean('annotator', 'fused', fallback=False)
+BATCH_SIZE = config.getint('annotator', 'batch_size', fallback=0)
+MEMORY_BUDGET_MB = config.getint('annotator', 'memory_budget_mb', fallback=0)
+REFERENCE_STORE = config.get('annotator', 'reference_store', fallback=None)
+WORKERS = config.getint('annotator', 'workers', fallback=0)
+BIN_QUERIES = config.getboolean('annotator', 'bin_queries', fallback=False)
+DBSNP_FILTER = config.get('annotator', 'dbsnp_filter', fallback=None)
+POINT_INDEX_DIR = config.get('annotator', 'point_index_dir', fallback=None)
+ANNOTATION_CACHE = config.get('annotator', 'annotation_cache', fallback=None)
+ANNOTATION_CACHE_SIZE = config.getint('annotator', 'annotation_cache_size',
+    fallback=1000000)
+RESULT_VERSION = config.get('annotator', 'result_version', fallback=None)
+# Seconds a worker process keeps the version of the reference data before
+# it looks it up again
+REFERENCE_VERSION_TTL = config.getint('annotator', 'reference_version_ttl',
+    fallback=300)
+CHECKPOINTS = config.getboolean('annotator', 'checkpoints', fallback=False)
+STAGE_LOG = config.getboolean('annotator', 'stage_log', fallback=False)
+PIPELINE_WORKERS = config.getint('annotator', 'pipeline_workers', fallback=0)
+PIPELINE_PROCESSES = config.getboolean('annotator', 'pipeline_processes',
+    fallback=False)
+QUEUE_DEPTH = config.getint('annotator', 'queue_depth', fallback=4)
+LOOKAHEAD = config.getint('annotator', 'lookahead', fallback=0)
+LOOKAHEAD_CONNECTIONS = config.getint('annotator', 'lookahead_connections',
+    fallback=4)
+COMPRESS_OUTPUT = config.getboolean('annotator', 'compress_output',
+    fallback=False)
+# Streamed inputs are kept on disk as well, so the job can be run again
+SPOOL_INPUT = config.getboolean('annotator', 'spool_input', fallback=True)
+SQS_QUEUE_URL = config.get('sqs', 'queue_url', fallback=None)
+VISIBILITY_TIMEOUT = config.getint('sqs', 'visibility_timeout', fallback=600)
+
+# Bumped when the annotation output changes for the same reference data
+PIPELINE_VERSION = '2'
 
 class Timer(object):
     def __init__(self, verbose=True):
@@ -72,45 +111,328 @@ def update_job_status(job_id, status, s3_result_bucket, s3_result_key, s3_log_ke
     except dynamodb.meta.client.exceptions.ConditionalCheckFailedException: # Job might be in a different state
         print(f"Job {job_id} status update failed. The job might be in a different state.")
 
+"""Keeps the job's SQS message invisible while the job runs
+   If the process dies the message shows up again after VISIBILITY_TIMEOUT
+   seconds, and the next worker resumes the job from its checkpoint.
+"""
+class VisibilityHeartbeat(threading.Thread):
+    def __init__(self, receipt_handle):
+        threading.Thread.__init__(self, daemon=True)
+        self.receipt_handle = receipt_handle
+        self.stopped = threading.Event()
+
+    def run(self):
+        sqs = boto3.client('sqs', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
+        while True:
+            try:
+                sqs.change_message_visibility(QueueUrl=SQS_QUEUE_URL,
+                    ReceiptHandle=self.receipt_handle,
+                    VisibilityTimeout=VISIBILITY_TIMEOUT)
+            except ClientError as e:
+                print(f"Error extending message visibility: {str(e)}")
+            if self.stopped.wait(VISIBILITY_TIMEOUT / 2):
+                break
+
+    def stop(self):
+        self.stopped.set()
+
+def delete_message(receipt_handle):
+    sqs = boto3.client('sqs', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
+    sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=receipt_handle)
+    print("Message deleted from the queue")
+
 def publish_job_completion(job_id,message):
     sns = boto3.client('sns',aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
     sns.publish(TopicArn=topic_arn, Message=message)
 
+def result_keys(input_file_name):
+    output_file_name = driver.annotatedPath(input_file_name, COMPRESS_OUTPUT)
+    log_file_name = input_file_name + '.count.log'
+    return f"{PREFIX}results/{output_file_name}", f"{PREFIX}logs/{log_file_name}"
+
+def stage_log_key(input_file_name):
+    return f"{PREFIX}stages/{input_file_name}.stages.gz"
+
+"""Stages a job runs (see driver.STAGE_REGISTRY): the stages of the user's
+   tier, from stages_<role> in [annotator] or driver.TIER_STAGES, narrowed
+   to the stages the job asked for, if any. None runs every stage.
+"""
+def job_stages(role=None, requested=None):
+    tier = None
+    if role and config.has_option('annotator', 'stages_' + role):
+        tier = [s.strip() for s in config.get('annotator', 'stages_' + role).split(',')]
+    elif role in driver.TIER_STAGES:
+        tier = driver.TIER_STAGES[role]
+    if requested:
+        tier = [s for s in requested if (tier is None) or (s in tier)]
+    if tier is None:
+        return None
+    return driver.resolveStages(tier)
+
+_reference_version = {}
+
+"""Version of the reference data (see annotcache.referenceVersion), looked
+   up again once it is REFERENCE_VERSION_TTL seconds old, so not for every
+   job of a worker process; None when the reference data has no version
+"""
+def current_reference_version():
+    if time.time() - _reference_version.get('time', 0) >= REFERENCE_VERSION_TTL:
+        import annotcache
+        import annotate as ann
+        import refstore
+        store = refstore.ReferenceStore(REFERENCE_STORE) if REFERENCE_STORE else None
+        conn = ann.stageConnect(store)
+        _reference_version['version'] = annotcache.referenceVersion(
+            conn.cursor(), store=store)
+        conn.close()
+        _reference_version['time'] = time.time()
+    return _reference_version['version']
+
+"""Version results are reused for: the pipeline, the reference data and
+   the stages, unless result_version is configured, and the output format;
+   None when the reference data has no version, and nothing is reused
+"""
+def result_version(stages=None):
+    if RESULT_VERSION:
+        return RESULT_VERSION + stages_suffix(stages) + format_suffix()
+    version = current_reference_version()
+    if version is None:
+        return None
+    return PIPELINE_VERSION + '-' + version + stages_suffix(stages) + \
+        format_suffix()
+
+def stages_suffix(stages):
+    if (stages is None) or (len(stages) == len(driver.STAGE_NAMES)):
+        return ''
+    return '-' + hashlib.sha1(','.join(stages).encode('utf-8')).hexdigest()[:12]
+
+def format_suffix():
+    return '-gz' if COMPRESS_OUTPUT else ''
+
+def result_index_key(content_hash, version):
+    return f"{PREFIX}index/{content_hash}-{version}.json"
+
+"""Result and log keys of an earlier job with the same input, or None
+"""
+def find_result(content_hash, version):
+    s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
+    try:
+        response = s3.get_object(Bucket=S3_RESULTS_BUCKET,
+            Key=result_index_key(content_hash, version))
+        return json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise e
+
+def record_result(content_hash, version, output_s3_key, log_s3_key):
+    s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
+    entry = {'s3_key_result_file': output_s3_key, 's3_key_log_file': log_s3_key}
+    try:
+        s3.put_object(Bucket=S3_RESULTS_BUCKET,
+            Key=result_index_key(content_hash, version),
+            Body=json.dumps(entry).encode('utf-8'))
+    except Exception as e:
+        print(f"Error recording result: {str(e)}")
+
+"""Completes a job from the results of an earlier job with the same input
+   The results are copied server-side to the keys of this job. Returns
+   False when there is no such job or its results are gone.
+"""
+def reuse_result(content_hash, version, input_file_name, job_id, email, user_id):
+    entry = find_result(content_hash, version)
+    if entry is None:
+        return False
+
+    s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
+    output_s3_key, log_s3_key = result_keys(input_file_name)
+    try:
+        for (src, dst) in [(entry['s3_key_result_file'], output_s3_key),
+            (entry['s3_key_log_file'], log_s3_key)]:
+            if src != dst:
+                s3.copy({'Bucket': S3_RESULTS_BUCKET, 'Key': src},
+                    S3_RESULTS_BUCKET, dst)
+            else:
+                s3.head_object(Bucket=S3_RESULTS_BUCKET, Key=src)
+    except ClientError as e:
+        print(f"Results of input {content_hash} cannot be reused: {str(e)}")
+        return False
+
+    print(f"Job {job_id} reuses the results of input {content_hash}")
+    update_job_status(job_id, 'COMPLETED', S3_RESULTS_BUCKET, output_s3_key, log_s3_key)
+    data = {
+        "email": email,
+        "job_id": job_id,
+        "user_id": user_id
+    }
+    publish_job_completion(job_id,str(data))
+    return True
+
+"""Annotates a local input file and publishes the results
+   Reference database connections stay in the process-wide pool, so a
+   worker that runs jobs in-process keeps them warm from job to job.
+   With the content hash of the input, the results are recorded for
+   reuse by later jobs with the same input.
+   Given the receipt handle of the job's SQS message, the message is kept
+   invisible while the job runs and deleted once the job is complete.
+   With checkpoints, finished stages are kept in S3 until then.
+   Given the (bucket, key) of the input in S3, it is annotated as it
+   downloads (see ingest.py), and spooled to input_file_path.
+   The annotation cache is kept for reference_version, or else for the
+   current_reference_version of this process.
+"""
+def run_job(input_file_path, job_id, email, user_id, content_hash=None,
+    version=None, receipt_handle=None, stages=None, input_s3=None,
+    reference_version=None):
+    if ANNOTATION_CACHE and reference_version is None:
+        reference_version = current_reference_version()
+
+    heartbeat = None
+    if receipt_handle:
+        heartbeat = VisibilityHeartbeat(receipt_handle)
+        heartbeat.start()
+
+    job_checkpoint = None
+    if CHECKPOINTS:
+        s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
+        job_checkpoint = checkpoint.S3Checkpoint(
+            input_file_path + '.checkpoint', S3_RESULTS_BUCKET,
+            f"{PREFIX}checkpoints/{job_id}/", s3=s3)
+
+    source = None
+    if input_s3:
+        s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
+        spool = input_file_path if SPOOL_INPUT else None
+        source = ingest.S3Input(input_s3[0], input_s3[1], s3, spool=spool)
+
+    try:
+        with Timer():
+            driver.run(input_file_path, 'vcf', fused=FUSED,
+                batch_size=BATCH_SIZE, memory_budget_mb=MEMORY_BUDGET_MB,
+                store_path=REFERENCE_STORE, workers=WORKERS,
+                bin_queries=BIN_QUERIES, dbsnp_filter=DBSNP_FILTER,
+                point_index_dir=POINT_INDEX_DIR,
+                annotation_cache=ANNOTATION_CACHE,
+                annotation_cache_size=ANNOTATION_CACHE_SIZE,
+                reference_version=reference_version,
+                checkpoint=job_checkpoint, stage_log=STAGE_LOG,
+                stages=stages, pipeline_workers=PIPELINE_WORKERS,
+                pipeline_processes=PIPELINE_PROCESSES,
+                queue_depth=QUEUE_DEPTH, lookahead=LOOKAHEAD,
+                lookahead_connections=LOOKAHEAD_CONNECTIONS,
+                compress_output=COMPRESS_OUTPUT, source=source)
+    finally:
+        if source is not None:
+            source.close()
+        if heartbeat is not None:
+            heartbeat.stop()
+
+    input_file_name = os.path.basename(input_file_path)
+    output_file_name = driver.annotatedPath(input_file_name, COMPRESS_OUTPUT)
+    output_file_path = os.path.join(os.path.dirname(input_file_path), output_file_name)
+    log_file_name = input_file_name + '.count.log'
+    log_file_path = os.path.join(os.path.dirname(input_file_path), log_file_name)
+
+    output_s3_key, log_s3_key = result_keys(input_file_name)
+    complete = os.path.exists(output_file_path) and os.path.exists(log_file_path)
+
+    if os.path.exists(output_file_path):
+        upload_to_s3(output_file_path, S3_RESULTS_BUCKET, output_s3_key)
+        delete_local_file(output_file_path)
+
+    # Compressed results are indexed, for region fetches (see tabix.py)
+    index_file_path = output_file_path + '.tbi'
+    if os.path.exists(index_file_path):
+        upload_to_s3(index_file_path, S3_RESULTS_BUCKET, output_s3_key + '.tbi')
+        delete_local_file(index_file_path)
+
+    if os.path.exists(log_file_path):
+        upload_to_s3(log_file_path, S3_RESULTS_BUCKET, log_s3_key)
+        delete_local_file(log_file_path)
+
+    # Kept with the result for re-annotation when reference tables change
+    stage_log_path = input_file_path + '.stages.gz'
+    if os.path.exists(stage_log_path):
+        upload_to_s3(stage_log_path, S3_RESULTS_BUCKET,
+            stage_log_key(input_file_name))
+        delete_local_file(stage_log_path)
+
+    if complete and content_hash and version:
+        record_result(content_hash, version, output_s3_key, log_s3_key)
+
+    update_job_status(job_id, 'COMPLETED', S3_RESULTS_BUCKET, output_s3_key, log_s3_key)
+    data = {
+        "email": email,
+        "job_id": job_id,
+        "user_id": user_id
+    }
+    publish_job_completion(job_id,str(data))  # Publish notification to SNS topic
+
+    if job_checkpoint is not None:
+        job_checkpoint.clear()
+    if receipt_handle:
+        delete_message(receipt_handle)
+
+
+"""Annotates the result of the job of input_file_path again after reference
+   tables changed (see driver.reannotate)
+   The result and the stage log are downloaded from the results bucket next
+   to input_file_path, and the new result, .count.log and stage log are
+   uploaded in their place.
+"""
+def reannotate_result(input_file_path):
+    s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=REGION)
+    input_file_name = os.path.basename(input_file_path)
+    output_s3_key, log_s3_key = result_keys(input_file_name)
+    output_file_path = os.path.join(os.path.dirname(input_file_path),
+        os.path.basename(output_s3_key))
+    log_file_path = input_file_path + '.count.log'
+    stage_log_path = input_file_path + '.stages.gz'
+    s3.download_file(S3_RESULTS_BUCKET, output_s3_key, output_file_path)
+    s3.download_file(S3_RESULTS_BUCKET, stage_log_key(input_file_name),
+        stage_log_path)
+
+    changed = driver.reannotate(input_file_path, 'vcf', batch_size=BATCH_SIZE,
+        store_path=REFERENCE_STORE, bin_queries=BIN_QUERIES,
+        dbsnp_filter=DBSNP_FILTER, point_index_dir=POINT_INDEX_DIR)
+
+    if changed:
+        upload_to_s3(output_file_path, S3_RESULTS_BUCKET, output_s3_key)
+        if os.path.exists(output_file_path + '.tbi'):
+            upload_to_s3(output_file_path + '.tbi', S3_RESULTS_BUCKET,
+                output_s3_key + '.tbi')
+        upload_to_s3(log_file_path, S3_RESULTS_BUCKET, log_s3_key)
+        upload_to_s3(stage_log_path, S3_RESULTS_BUCKET,
+            stage_log_key(input_file_name))
+    for path in [output_file_path, output_file_path + '.tbi', log_file_path,
+        stage_log_path]:
+        if os.path.exists(path):
+            delete_local_file(path)
+
+
 if __name__ == '__main__':
     if len(sys.argv) > 4:
         input_file_path = sys.argv[1]
         job_id = sys.argv[2]
         email = sys.argv[3]
         user_id = sys.argv[4]
+        # Optional: content hash, result version, SQS receipt handle,
+        # comma-separated stages, s3://bucket/key of an input to stream,
+        # reference version
+        extra = sys.argv[5:] + [''] * 6
+        content_hash = extra[0] or None
+        version = extra[1] or None
+        receipt_handle = extra[2] or None
+        stages = extra[3].split(',') if extra[3] else None
+        input_s3 = None
+        if extra[4].startswith('s3://'):
+            input_s3 = tuple(extra[4][len('s3://'):].split('/', 1))
+        reference_version = extra[5] or None
 
-        with Timer():
-            driver.run(input_file_path, 'vcf')
-
-        input_file_name = os.path.basename(input_file_path)
-        output_file_name = input_file_name.replace('.vcf', '.annot.vcf')
-        output_file_path = os.path.join(os.path.dirname(input_file_path), output_file_name)
-        log_file_name = input_file_name + '.count.log'
-        log_file_path = os.path.join(os.path.dirname(input_file_path), log_file_name)
-
-        prefix = PREFIX
-        output_s3_key = f"{prefix}results/{output_file_name}"
-        log_s3_key = f"{prefix}logs/{log_file_name}"
-
-        if os.path.exists(output_file_path):
-            upload_to_s3(output_file_path, S3_RESULTS_BUCKET, output_s3_key)
-            delete_local_file(output_file_path)
-
-        if os.path.exists(log_file_path):
-            upload_to_s3(log_file_path, S3_RESULTS_BUCKET, log_s3_key)
-            delete_local_file(log_file_path)
-
-        update_job_status(job_id, 'COMPLETED', S3_RESULTS_BUCKET, output_s3_key, log_s3_key)
-        data = {
-            "email": email,
-            "job_id": job_id,
-            "user_id": user_id
-        }
-        publish_job_completion(job_id,str(data))  # Publish notification to SNS topic
+        run_job(input_file_path, job_id, email, user_id,
+            content_hash=content_hash, version=version,
+            receipt_handle=receipt_handle, stages=stages, input_s3=input_s3,
+            reference_version=reference_version)
 
     else:
         print("Please provide a valid .vcf file path and job ID as input to this program.")
\ No newline at end of file
@@ -0,0 +1,190 @@
+# stagelog.py
+#
+# Per-record log of what every stage added, for incremental re-annotation
+#
+# A fused run can write a stage log next to its .annot.vcf. Its first line
+# holds the version of the reference tables each stage read (see
+# stageVersion in annotcache.py); every other line belongs to one record and
+# holds its original ID and INFO and, by stage, the context the stage saw
+# and the entry it added (see RecordAnnotator.contribution in annotate.py).
+#
+# After tables are updated, reannotate in driver.py takes the .annot.vcf back
+# to the input records and runs them through the stages again. Logged entries
+# of stages whose version did not change are replayed; only stages whose
+# tables changed, and records a changed stage left in a different context
+# for a later one, are looked up again. Run it with:
+#
+#   python stagelog.py <file.vcf> [reference store]
+#   python stagelog.py --s3 <file.vcf>
+#
+# where <file.vcf> is the input the .annot.vcf was made from. With --s3, the
+# result and the stage log of its job are fetched from the results bucket
+# and replaced there (see reannotate_result in run.py), with the settings of
+# ann_config.ini.
+#
+##
+
+import sys
+import os
+import gzip
+import json
+
+import vcfrecord
+
+
+"""Stage log written for the annotated output of infile
+"""
+def stageLogPath(infile):
+    return infile + '.stages.gz'
+
+
+"""Records what every stage adds to every record
+   Used in place of an AnnotationCache (see annotcache.py); lookups and
+   entries are passed on to cache, if given.
+"""
+class StageLog(object):
+    def __init__(self, path, versions, cache=None):
+        self.path = path
+        self.cache = cache
+        self.reportHits = cache is not None
+        self.record = None
+        self.fh = gzip.open(path + '.tmp', 'wt')
+        self.fh.write(json.dumps({'versions': versions}) + '\n')
+
+    def startRecord(self, fields):
+        self.record = {'id': fields[2], 'info': str(fields.getInfo()),
+            'stages': {}}
+        if self.cache is not None:
+            self.cache.startRecord(fields)
+
+    def get(self, stage, variant, context):
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.get(stage, variant, context)
+        if entry is not None:
+            self.record['stages'][stage] = [context, entry]
+        return entry
+
+    def known(self, stage, variants):
+        if self.cache is not None:
+            return self.cache.known(stage, variants)
+        return set()
+
+    def put(self, stage, variant, context, entry):
+        self.record['stages'][stage] = [context, entry]
+        if self.cache is not None:
+            self.cache.put(stage, variant, context, entry)
+
+    def recordDone(self):
+        self.fh.write(json.dumps(self.record) + '\n')
+        self.record = None
+        if self.cache is not None:
+            self.cache.recordDone()
+
+    def flush(self):
+        if self.cache is not None:
+            self.cache.flush()
+
+    """Closes the log; it only replaces the log of an earlier run once the
+       run it belongs to is complete
+    """
+    def close(self):
+        self.fh.close()
+        os.replace(self.path + '.tmp', self.path)
+
+
+"""Reads a stage log record by record
+"""
+class StageLogReader(object):
+    def __init__(self, path):
+        self.fh = gzip.open(path, 'rt')
+        self.versions = json.loads(self.fh.readline())['versions']
+
+    def next(self):
+        line = self.fh.readline()
+        if (len(line) == 0):
+            raise IOError("Stage log ends before the annotated file")
+        return json.loads(line)
+
+    def close(self):
+        self.fh.close()
+
+
+"""Record line of the input that an annotated line was made from, given
+   its record in the stage log
+"""
+def originalLine(line, record):
+    cols = line.split('\t')
+    joined = [s for s in record['stages'].values() if s[1].get('joined')]
+    if (len(joined) > 0):
+        # Rejoining put one space in front of every column but the first
+        cols = [cols[0]] + [c[1:] for c in cols[1:]]
+    cols[2] = record['id']
+    cols[vcfrecord.INFO_COLUMN] = record['info']
+    return '\t'.join(cols)
+
+
+"""Replays a stage log while the records are annotated again
+   Stages whose version changed or is unknown (None, see stageVersion in
+   annotcache.py), and stages that see a record in another context than
+   they did when it was logged, are run; the rest replay the logged entry.
+   The new log is written to log, a StageLog.
+"""
+class StageReplay(object):
+    # Hits are replays, not cache hits; they are kept out of the .count.log
+    reportHits = False
+
+    def __init__(self, reader, versions, log):
+        self.reader = reader
+        self.log = log
+        self.changed = set([s for s in versions if (versions[s] is None)
+            or (reader.versions.get(s) != versions[s])])
+        self.record = None
+
+    def startRecord(self, fields):
+        self.record = self.reader.next()
+        self.log.startRecord(fields)
+
+    def get(self, stage, variant, context):
+        if stage in self.changed:
+            return None
+        logged = self.record['stages'].get(stage)
+        if (logged is None) or (logged[0] != context):
+            return None
+        self.log.put(stage, variant, context, logged[1])
+        return logged[1]
+
+    """Stages that did not change have nothing to prefetch
+    """
+    def known(self, stage, variants):
+        if stage in self.changed:
+            return set()
+        return set(variants)
+
+    def put(self, stage, variant, context, entry):
+        self.log.put(stage, variant, context, entry)
+
+    def recordDone(self):
+        self.log.recordDone()
+
+    def flush(self):
+        self.log.flush()
+
+
+if __name__ == '__main__':
+    import driver
+
+    if (len(sys.argv) > 2) and (sys.argv[1] == '--s3'):
+        import run
+        run.reannotate_result(sys.argv[2])
+
+    elif len(sys.argv) > 1:
+        store_path = None
+        if len(sys.argv) > 2:
+            store_path = sys.argv[2]
+        driver.reannotate(sys.argv[1], 'vcf', store_path=store_path)
+
+    else:
+        print("Please provide the .vcf file the annotated file was made from.")
+
+### EOF
@@ -0,0 +1,315 @@
+# tabix.py
+#
+# Coordinate index of compressed results, and region fetches through it
+#
+# Compressed results (see bgzf.py) are indexed as they are written: every
+# record goes in the smallest bin of the tabix scheme (see binning.py) that
+# holds it, with the virtual offsets it starts and ends at, and every 16 kb
+# window of a chromosome keeps the lowest offset of a record over it. The
+# index is saved next to the result, as <result>.tbi in the format of tabix,
+# so that tabix and htslib can read it as well. Like tabix, the index needs
+# the records sorted by position within every chromosome, and the records of
+# a chromosome together; output that is not sorted is not indexed. fetch
+# reads the records over a region through the index; from S3, every run of
+# blocks it needs is one ranged GET. Run it with:
+#
+#   python tabix.py <file.annot.vcf.gz | s3://bucket/key> chrom:start-end
+#
+##
+
+import os
+import sys
+import gzip
+import struct
+
+import boto3
+
+import bgzf
+import binning
+
+TBI_MAGIC = b'TBI\x01'
+# Preset of tabix for VCF: sequence, begin and end columns, meta character
+TBI_PRESET = (2, 1, 2, 0, ord('#'), 0)
+LINEAR_SHIFT = 14
+# Bound on the size of a BGZF block on disk
+MAX_BLOCK_SIZE = 0x10000
+
+
+def indexPath(path):
+    return path + '.tbi'
+
+
+"""Chromosome and 0-based, half-open range of a record line; None for
+   header lines and lines that are not records
+   As in htslib, a record ends at the END of its INFO, if that is past its
+   position, and after its REF otherwise.
+"""
+def recordRange(line):
+    if line.startswith('#'):
+        return None
+    cols = line.split('\t', 8)
+    if (len(cols) < 4):
+        return None
+    try:
+        pos = int(cols[1])
+    except ValueError:
+        return None
+    start = max(pos - 1, 0)
+    end = start + max(len(cols[3].strip()), 1)
+    if (len(cols) > 7):
+        info = ';' + cols[7].strip()
+        i = info.find(';END=')
+        if (i >= 0):
+            value = info[i + 5:].split(';', 1)[0]
+            try:
+                if (int(value) > start):
+                    end = int(value)
+            except ValueError:
+                pass
+    return cols[0], start, end
+
+
+"""Lowest offset of a record in every window or any window after it, so
+   that a window without records still bounds the records after it
+"""
+def linearOffsets(linear):
+    offsets = [0] * len(linear)
+    lowest = None
+    for w in range(len(linear) - 1, -1, -1):
+        if (linear[w] is not None) and \
+            ((lowest is None) or (linear[w] < lowest)):
+            lowest = linear[w]
+        offsets[w] = lowest
+    return offsets
+
+
+"""Index of one BGZF file: by chromosome, the chunks of virtual offsets in
+   every bin and the linear index of 16 kb windows
+"""
+class TabixIndex(object):
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+        # First record out of order, as chrom:pos
+        self.unsorted = None
+        self.lastStart = 0
+
+    """Adds a line written from virtual offset start up to end
+    """
+    def add(self, line, start, end):
+        record = recordRange(line)
+        if record is None:
+            return
+        name, first, last = record
+        if (self.unsorted is None) and (len(self.names) > 0) and \
+            (((name == self.names[-1]) and (first < self.lastStart)) or \
+            ((name != self.names[-1]) and (name in self.refs))):
+            self.unsorted = f"{name}:{first + 1}"
+        self.lastStart = first
+        if name not in self.refs:
+            self.names.append(name)
+            self.refs[name] = ({}, [])
+        bins, linear = self.refs[name]
+
+        chunks = bins.setdefault(binning.binFromRange(first, last,
+            binning.TABIX_BIN_OFFSETS, binning.TABIX_FIRST_SHIFT), [])
+        if (len(chunks) > 0) and (chunks[-1][1] == start):
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+
+        lastWindow = (last - 1) >> LINEAR_SHIFT
+        if (len(linear) <= lastWindow):
+            linear.extend([None] * (lastWindow + 1 - len(linear)))
+        for w in range(first >> LINEAR_SHIFT, lastWindow + 1):
+            if (linear[w] is None) or (start < linear[w]):
+                linear[w] = start
+
+    """Writes the index in the .tbi format, itself BGZF; an index of
+       records out of order is not written, and one already at path removed
+    """
+    def save(self, path):
+        if self.unsorted is not None:
+            print(f"Not indexed: records out of order at {self.unsorted}")
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        names = b''.join([n.encode('utf-8') + b'\0' for n in self.names])
+        data = [TBI_MAGIC, struct.pack('<i', len(self.names)),
+            struct.pack('<6i', *TBI_PRESET), struct.pack('<i', len(names)),
+            names]
+        for name in self.names:
+            bins, linear = self.refs[name]
+            data.append(struct.pack('<i', len(bins)))
+            for b in sorted(bins):
+                data.append(struct.pack('<Ii', b, len(bins[b])))
+                for chunk in bins[b]:
+                    data.append(struct.pack('<QQ', chunk[0], chunk[1]))
+            offsets = linearOffsets(linear)
+            data.append(struct.pack(f'<i{len(offsets)}Q', len(offsets),
+                *offsets))
+        # Records without coordinates
+        data.append(struct.pack('<Q', 0))
+
+        out = bgzf.BgzfWriter(path)
+        out.writeBytes(b''.join(data))
+        out.close()
+
+    """Merged chunks of virtual offsets that hold every record of name
+       over [start, end), in file order
+    """
+    def chunks(self, name, start, end):
+        if name not in self.refs:
+            return []
+        bins, linear = self.refs[name]
+        end = min(end, binning.BIN_MAX_END)
+        if (start >= end):
+            return []
+
+        # Chunks that end before the first record over the window of start
+        # cannot hold a record over [start, end)
+        lowest = 0
+        if (len(linear) > 0):
+            lowest = linearOffsets(linear)[min(start >> LINEAR_SHIFT,
+                len(linear) - 1)] or 0
+
+        found = []
+        for b in binning.overlappingBins(start, end, binning.TABIX_BIN_OFFSETS,
+            binning.TABIX_FIRST_SHIFT):
+            found.extend([c for c in bins.get(b, []) if c[1] > lowest])
+        found.sort()
+
+        # Chunks that overlap or meet in a block are read at once
+        merged = []
+        for chunk in found:
+            if (len(merged) > 0) and ((chunk[0] <= merged[-1][1]) or \
+                (chunk[0] >> 16 == merged[-1][1] >> 16)):
+                merged[-1][1] = max(merged[-1][1], chunk[1])
+            else:
+                merged.append(list(chunk))
+        return merged
+
+
+"""Index read from the bytes of a .tbi file
+"""
+def readIndex(data):
+    data = gzip.decompress(data)
+    if (data[:4] != TBI_MAGIC):
+        raise IOError("Not a tabix index")
+    index = TabixIndex()
+    count = struct.unpack_from('<i', data, 4)[0]
+    length = struct.unpack_from('<i', data, 32)[0]
+    index.names = [n.decode('utf-8') for n in
+        data[36:36 + length].split(b'\0')[:count]]
+    pos = 36 + length
+    for name in index.names:
+        bins = {}
+        binCount = struct.unpack_from('<i', data, pos)[0]
+        pos = pos + 4
+        for i in range(0, binCount):
+            b, chunkCount = struct.unpack_from('<Ii', data, pos)
+            pos = pos + 8
+            bins[b] = [list(struct.unpack_from('<QQ', data, pos + 16 * j))
+                for j in range(0, chunkCount)]
+            pos = pos + 16 * chunkCount
+        windows = struct.unpack_from('<i', data, pos)[0]
+        linear = list(struct.unpack_from(f'<{windows}Q', data, pos + 4))
+        pos = pos + 4 + 8 * windows
+        index.refs[name] = (bins, linear)
+    return index
+
+
+"""Record lines of name over [start, end), read through index
+   read(first, last) returns the bytes of the file from offset first up to
+   last, or up to its end.
+"""
+def fetch(read, index, name, start, end):
+    lines = []
+    for chunk in index.chunks(name, start, end):
+        first = chunk[0] >> 16
+        last = chunk[1] >> 16
+        # The block at last is only needed if the chunk ends inside it
+        if (chunk[1] & 0xffff):
+            data = read(first, last + MAX_BLOCK_SIZE)
+        else:
+            data = read(first, last)
+
+        text = []
+        for offset, block in bgzf.readBlocks(data, first):
+            if (offset == last):
+                text.append(block[:chunk[1] & 0xffff])
+                break
+            text.append(block)
+        text = b''.join(text)[chunk[0] & 0xffff:].decode('utf-8')
+
+        for line in text.split('\n'):
+            record = recordRange(line)
+            if (record is not None) and (record[0] == name) and \
+                (record[1] < end) and (record[2] > start):
+                lines.append(line)
+    return lines
+
+
+def fileReader(path):
+    def read(first, last):
+        fh = open(path, 'rb')
+        fh.seek(first)
+        data = fh.read(last - first)
+        fh.close()
+        return data
+    return read
+
+
+"""Reads ranges of an S3 object with ranged GETs
+"""
+def s3Reader(bucket, key, s3):
+    def read(first, last):
+        response = s3.get_object(Bucket=bucket, Key=key,
+            Range=f"bytes={first}-{last - 1}")
+        return response['Body'].read()
+    return read
+
+
+"""Record lines of the compressed result at path over name:[start, end)
+"""
+def fetchFile(path, name, start, end):
+    fh = open(indexPath(path), 'rb')
+    index = readIndex(fh.read())
+    fh.close()
+    return fetch(fileReader(path), index, name, start, end)
+
+
+"""Record lines of the compressed result bucket/key over name:[start, end);
+   only the index and the blocks that hold them are downloaded
+"""
+def fetchS3(bucket, key, name, start, end, s3=None):
+    s3 = s3 or boto3.client('s3')
+    response = s3.get_object(Bucket=bucket, Key=indexPath(key))
+    index = readIndex(response['Body'].read())
+    return fetch(s3Reader(bucket, key, s3), index, name, start, end)
+
+
+"""Chromosome and 0-based, half-open range of a chrom:start-end region,
+   with 1-based, inclusive start and end as tabix takes them
+"""
+def parseRegion(region):
+    name, span = region.rsplit(':', 1)
+    start, end = span.replace(',', '').split('-')
+    return name, int(start) - 1, int(end)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        name, start, end = parseRegion(sys.argv[2])
+        if sys.argv[1].startswith('s3://'):
+            bucket, key = sys.argv[1][len('s3://'):].split('/', 1)
+            lines = fetchS3(bucket, key, name, start, end)
+        else:
+            lines = fetchFile(sys.argv[1], name, start, end)
+        for line in lines:
+            print(line)
+
+    else:
+        print("Please provide a compressed result and a chrom:start-end.")
+
+### EOF
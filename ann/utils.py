@@ -13,25 +13,47 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# Seconds the RDS credentials are cached for, and connections per process
+SECRET_TTL = int(os.environ.get('ANN_DB_SECRET_TTL', 900))
+POOL_SIZE = int(os.environ.get('ANN_DB_POOL_SIZE', 4))
+# Seconds a borrower waits for a pooled connection before giving up
+POOL_TIMEOUT = float(os.environ.get('ANN_DB_POOL_TIMEOUT', 300))
+
+_secret = {'value': None, 'fetched': 0}
+_secret_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+
+"""Get RDS secret from AWS Secrets Manager
+   The secret is cached for SECRET_TTL seconds
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+def getRdsSecret(refresh=False):
+    with _secret_lock:
+        if refresh or (_secret['value'] is None) or \
+            (time.time() - _secret['fetched'] > SECRET_TTL):
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+                _secret['value'] = json.loads(asm_response['SecretString'])
+                _secret['fetched'] = time.time()
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                raise e
+
+        return _secret['value']
+
+
+def connectWithSecret(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret['host']
     mysql_port = rds_secret['port']
@@ -48,6 +70,156 @@ def db_connect():
         db=database_name)
 
 
+"""Get connection to reference database
+"""
+def db_connect():
+    try:
+        return connectWithSecret(getRdsSecret())
+    except pymysql.err.OperationalError:
+        # The cached credentials may have been rotated
+        return connectWithSecret(getRdsSecret(refresh=True))
+
+
+"""Connection borrowed from a ConnectionPool; close() gives it back
+"""
+class PooledConnection(object):
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+
+    def cursor(self, *args):
+        return self.conn.cursor(*args)
+
+    def close(self):
+        if self.conn is not None:
+            self.pool.release(self.conn)
+            self.conn = None
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+"""Process-wide pool of reference database connections
+   Idle connections stay open between stages and between jobs run by the
+   same process, with their transaction rolled back. A borrowed connection
+   is pinged first, and replaced when it cannot reconnect. At most size
+   connections are open; borrowers wait up to timeout seconds for one to be
+   returned after that.
+"""
+class ConnectionPool(object):
+    def __init__(self, size=POOL_SIZE, connect=db_connect,
+        timeout=POOL_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self.connect = connect
+        self.idle = []
+        self.open = 0
+        self.cond = threading.Condition()
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def acquire(self):
+        conn = None
+        with self.cond:
+            start = None
+            while (len(self.idle) == 0) and (self.open >= self.size):
+                if start is None:
+                    start = time.time()
+                    self.waits = self.waits + 1
+                remaining = start + self.timeout - time.time()
+                if (remaining <= 0):
+                    self.wait_time = self.wait_time + (time.time() - start)
+                    raise TimeoutError(f"No pooled connection returned " + \
+                        f"after {self.timeout}s; all {self.size} are in use")
+                self.cond.wait(remaining)
+            if start is not None:
+                self.wait_time = self.wait_time + (time.time() - start)
+
+            if (len(self.idle) > 0):
+                conn = self.idle.pop()
+                self.hits = self.hits + 1
+            else:
+                self.open = self.open + 1
+                self.misses = self.misses + 1
+
+        if conn is not None:
+            try:
+                conn.ping(reconnect=True)
+                return PooledConnection(self, conn)
+            except pymysql.err.Error:
+                self.discard(conn)
+                with self.cond:
+                    self.open = self.open + 1
+
+        try:
+            return PooledConnection(self, self.connect())
+        except Exception as e:
+            with self.cond:
+                self.open = self.open - 1
+                self.cond.notify()
+            raise e
+
+    """Gives conn back; its transaction is ended first, so it does not
+       keep reading the snapshot it took for the next borrower
+    """
+    def release(self, conn):
+        try:
+            conn.rollback()
+        except pymysql.err.Error:
+            self.discard(conn)
+            return
+        with self.cond:
+            self.idle.append(conn)
+            self.cond.notify()
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+        with self.cond:
+            self.open = self.open - 1
+            self.cond.notify()
+
+    def closeAll(self):
+        with self.cond:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            self.discard(conn)
+
+    def stats(self):
+        with self.cond:
+            return {'hits': self.hits, 'misses': self.misses,
+                'waits': self.waits, 'wait_time': self.wait_time,
+                'open': self.open, 'idle': len(self.idle)}
+
+
+def getPool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+"""Drops the pool inherited by a forked process without closing its
+   connections; their sockets still belong to the parent
+"""
+def resetPool():
+    global _pool
+    _pool = None
+
+
+"""Get pooled connection to reference database
+"""
+def db_pool_connect():
+    return getPool().acquire()
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
@@ -0,0 +1,152 @@
+# vcfrecord.py
+#
+# Lazy view of one VCF record for the annotation stages
+#
+# Only the 8 fixed columns (CHROM .. INFO) are split. FORMAT and the sample
+# columns stay one string, exactly as read, and are written back verbatim,
+# so the cost of a record does not grow with the number of samples. INFO is
+# an InfoField that stages add their annotations to.
+#
+##
+
+FIXED_COLUMNS = 8
+INFO_COLUMN = 7
+
+
+"""INFO column of a record, parsed once
+   Stages add annotations instead of concatenating strings; the text is
+   only joined when it is read or written. Keys are looked up in a dict
+   built on first use, which keeps the first value of a repeated key.
+"""
+class InfoField(object):
+    __slots__ = ('pieces', 'values')
+
+    def __init__(self, text):
+        self.pieces = [text]
+        self.values = None
+
+    def __str__(self):
+        if (len(self.pieces) > 1):
+            self.pieces = [''.join(self.pieces)]
+        return self.pieces[0]
+
+    def endswith(self, suffix):
+        last = self.pieces[-1]
+        if (len(last) >= len(suffix)):
+            return last.endswith(suffix)
+        return str(self).endswith(suffix)
+
+    def startswith(self, prefix):
+        first = self.pieces[0]
+        if (len(first) >= len(prefix)):
+            return first.startswith(prefix)
+        return str(self).startswith(prefix)
+
+    """True for the missing value '.'
+    """
+    def isMissing(self):
+        return str(self) == '.'
+
+    def parseInto(self, text):
+        for item in text.split(';'):
+            if (len(item) == 0):
+                continue
+            key, eq, value = item.partition('=')
+            if key not in self.values:
+                self.values[key] = value
+
+    """Value of key, '' for flags and default when key is not there
+    """
+    def get(self, key, default='.'):
+        if self.values is None:
+            self.values = {}
+            self.parseInto(str(self))
+        return self.values.get(key, default)
+
+    """Adds text as it is
+    """
+    def append(self, text):
+        if self.values is not None:
+            if text.startswith(';') or self.endswith(';'):
+                self.parseInto(text)
+            else:
+                # text continues the last item
+                self.values = None
+        self.pieces.append(text)
+
+    """Adds item after a ';', unless the field already ends with one
+    """
+    def add(self, item):
+        if self.endswith(';'):
+            self.append(item)
+        else:
+            self.append(';' + item)
+
+    def set(self, text):
+        self.pieces = [text]
+        self.values = None
+
+
+"""Fixed columns of a record as a list, plus the untouched tail
+   Stages index and assign the fixed columns like a list of fields.
+"""
+class VcfRecord(object):
+    __slots__ = ('fields', 'tail', 'info')
+
+    def __init__(self, line, sep='\t'):
+        self.tail = None
+        self.info = None
+        if (sep != '\t'):
+            # Written back tab-separated, so every column is split
+            self.fields = line.split(sep)
+            return
+        self.fields = line.split(sep, FIXED_COLUMNS)
+        if (len(self.fields) > FIXED_COLUMNS):
+            self.tail = self.fields.pop()
+
+    """INFO of the record as an InfoField
+    """
+    def getInfo(self):
+        if self.info is None:
+            self.info = InfoField(self.fields[INFO_COLUMN])
+        return self.info
+
+    # Writes the InfoField back to the fields
+    def flush(self):
+        if self.info is not None:
+            self.fields[INFO_COLUMN] = str(self.info)
+
+    def __getitem__(self, i):
+        self.flush()
+        return self.fields[i]
+
+    def __setitem__(self, i, value):
+        self.flush()
+        self.info = None
+        self.fields[i] = value
+
+    def __len__(self):
+        if self.tail is None:
+            return len(self.fields)
+        return len(self.fields) + self.tail.count('\t') + 1
+
+    """Last column of the record, as a full split would see it
+    """
+    def lastColumn(self):
+        self.flush()
+        if self.tail is None:
+            return self.fields[-1]
+        return self.tail[self.tail.rfind('\t') + 1:]
+
+    """Same record with its columns joined by sep instead of tabs
+    """
+    def joinedBy(self, sep):
+        return VcfRecord(self.toLine().replace('\t', sep))
+
+    def toLine(self):
+        self.flush()
+        if self.tail is None:
+            return '\t'.join(self.fields)
+        return '\t'.join(self.fields) + '\t' + self.tail
+
+### EOF
@@ -122,6 +122,7 @@ def create_annotation_job_request():
   
   profile = get_profile(session['primary_identity'])
   data['email'] = profile.email
+  data['role'] = profile.role  # selects the annotation stages of the tier
 
   response = sns_client.publish(
       TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'],